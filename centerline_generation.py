@@ -99,7 +99,6 @@ def centerline_map(sample, split, data_path):
 if __name__ == "__main__":
     import multiprocessing as mp
     import datasets
-    from datasets.arrow_dataset import _concatenate_map_style_datasets
     from datasets import Dataset
     from functools import partial
     from tqdm import tqdm
@@ -123,14 +122,12 @@ if __name__ == "__main__":
     # root = "/localdata_ssd/nuplan/online_float32_opt/index/val/"
     root = os.path.join(data_path, "index", args.split)
     subset_dirs = os.listdir(root)
-    alldatasets = list()
-    for i, subset_dir in enumerate(subset_dirs):
-        if i >= args.start_id and i < args.end_id:
-            print(f"loading {subset_dir}")
-            dataset = datasets.load_from_disk(os.path.join(root, subset_dir))
-            alldatasets.append(dataset)
-        
-    dataset = _concatenate_map_style_datasets(alldatasets)
+    subset_dirs = subset_dirs[args.start_id:args.end_id]
+    for subset_dir in subset_dirs:
+        print(f"loading {subset_dir}")
+    alldatasets = [datasets.load_from_disk(os.path.join(root, subset_dir)) for subset_dir in subset_dirs]
+
+    dataset = datasets.concatenate_datasets(alldatasets)
     print(dataset)
     
     
@@ -37,8 +37,8 @@ def yield_diffusion_dataset(shards, root):
         if not os.path.exists(os.path.join(root, hidden_state_name + str(shard) + ".pth")):
             print(f'{os.path.join(root, hidden_state_name + str(shard) + ".pth")} does not exist!')
             continue
-        label_in_batch = torch.load(os.path.join(root, label_name + str(shard) + ".pth"))
-        hidden_state_in_batch = torch.load(os.path.join(root, hidden_state_name + str(shard) + ".pth"))
+        label_in_batch = torch.load(os.path.join(root, label_name + str(shard) + ".pth"), map_location="cpu", weights_only=True)
+        hidden_state_in_batch = torch.load(os.path.join(root, hidden_state_name + str(shard) + ".pth"), map_location="cpu", weights_only=True)
         assert label_in_batch.shape[0] == hidden_state_in_batch.shape[0]
         for i in range(label_in_batch.shape[0]):
             item = dict(
@@ -47,9 +47,40 @@ def yield_diffusion_dataset(shards, root):
             )
             yield item
 
+def yield_diffusion_shard_dataset(ranks, root):
+    # raw shards appended by KeyPointMLPDeocder with diffusion_feature_shard
+    import json
+    import numpy as np
+    for rank in ranks:
+        with open(os.path.join(root, f"future_key_points_rank{rank}.json")) as f:
+            meta = json.load(f)
+        hidden_states = np.memmap(os.path.join(root, f"future_key_points_hidden_state_rank{rank}.bin"), dtype=meta["dtype"], mode="r")
+        labels = np.memmap(os.path.join(root, f"future_key_points_rank{rank}.bin"), dtype=meta["dtype"], mode="r")
+        hidden_states = hidden_states.reshape(-1, *meta["hidden_state_shape"])
+        labels = labels.reshape(-1, *meta["label_shape"])
+        assert labels.shape[0] == hidden_states.shape[0]
+        for i in range(labels.shape[0]):
+            item = dict(
+                label = torch.from_numpy(np.array(labels[i])),
+                hidden_state = torch.from_numpy(np.array(hidden_states[i]))
+            )
+            yield item
+
 def generate_arrow_dataset(args):
     from datasets import Dataset
     items = os.listdir(args.data_dir)
+    ranks = [int(item.split("rank")[-1].split(".")[0]) for item in items if item.startswith("future_key_points_rank") and item.endswith(".json")]
+    if len(ranks) > 0:
+        print(f"generating dataset from {args.data_dir}, with shards of {len(ranks)} ranks.")
+        dataset = Dataset.from_generator(
+            yield_diffusion_shard_dataset,
+            gen_kwargs={"ranks": ranks, "root": args.data_dir},
+            writer_batch_size=10,
+            cache_dir=args.save_dir,
+            num_proc=args.num_proc,
+        )
+        dataset.save_to_disk(os.path.join(args.save_dir, args.dataset_name))
+        return
     shards = set()
     for item in items:
         if item.endswith(".pth"):
@@ -19,7 +19,7 @@ import numpy as np
 import evaluate
 import transformers
 from datasets import Dataset
-from datasets.arrow_dataset import _concatenate_map_style_datasets
+from datasets import concatenate_datasets
 from functools import partial
 
 from transformers import (
@@ -45,24 +45,18 @@ from datasets import Dataset, Value
 logger = logging.getLogger(__name__)
 
 def load_dataset(root, split='train', dataset_scale=1, select=False):
-    datasets = []
     index_root_folders = os.path.join(root, split)
     indices = os.listdir(index_root_folders)
  
-    for index in indices:
-        index_path = os.path.join(index_root_folders, index)
-        if os.path.isdir(index_path):
-            # load training dataset
-            logger.info("Loading training dataset {}".format(index_path))
-            dataset = Dataset.load_from_disk(index_path)
-            if dataset is not None:
-                datasets.append(dataset)
-        else:
-            continue
+    index_paths = [os.path.join(index_root_folders, index) for index in indices
+                   if os.path.isdir(os.path.join(index_root_folders, index))]
+    for index_path in index_paths:
+        logger.info("Loading training dataset {}".format(index_path))
+    datasets = [dataset for dataset in map(Dataset.load_from_disk, index_paths) if dataset is not None]
     # For nuplan dataset directory structure, each split obtains multi cities directories, so concat is required;
     # But for waymo dataset, index directory is just the datset, so load directory directly to build dataset. 
     if len(datasets) > 0: 
-        dataset = _concatenate_map_style_datasets(datasets)
+        dataset = concatenate_datasets(datasets)
     else: 
         dataset = Dataset.load_from_disk(index_root_folders)
     # add split column
@@ -302,12 +296,14 @@ def main():
     # First we generate the testing set for our diffusion decoder.
     print("We skip generating diff feats for eval set.")
     result = trainer.evaluate()
+    trainer.model.key_points_decoder.wait_for_saved_features()
     logger.info(f"during eval set generation: {result}")
     
     trainer.model.key_points_decoder.save_testing_diffusion_feature_dir = model.key_points_decoder.save_testing_diffusion_feature_dir[:-4] + 'train/'
     # print("Now generating the other 40%.")
     trainer.eval_dataset = train_dataset.select(range(int(len(train_dataset)*0),len(train_dataset)))
     result = trainer.evaluate()
+    trainer.model.key_points_decoder.wait_for_saved_features()
     logger.info(f"during training set generation: {result}")
     # try:
     #     if model_args.autoregressive or True:
@@ -326,6 +322,7 @@ def main():
     trainer.model.key_points_decoder.save_testing_diffusion_feature_dir = model.key_points_decoder.save_testing_diffusion_feature_dir[:-6] + 'test/'
     trainer.eval_dataset = test_dataset
     result = trainer.evaluate()
+    trainer.model.key_points_decoder.wait_for_saved_features()
     logger.info(f"during testing set generation: {result}")
         
 
@@ -11,7 +11,7 @@ from nuplan.planning.simulation.trajectory.interpolated_trajectory import Interp
 from nuplan.planning.simulation.observation.idm.utils import path_to_linestring
 
 # packages for STR model
-from transformer4planning.models.backbone.str_base import build_model_from_path
+from transformer4planning.models.backbone.str_base import build_eval_model_from_path, eval_model_lock
 from nuplan.common.actor_state.state_representation import Point2D
 from transformer4planning.utils.nuplan_utils import get_angle_of_a_line
 from nuplan_simulation.route_corrections.route_utils import route_roadblock_correction
@@ -51,9 +51,7 @@ class Planner(AbstractPlanner):
         # self._trajectory_planner = TreePlanner(self._device, self._encoder, self._decoder)
 
     def _initialize_model(self):
-        self._model = build_model_from_path(self._model_path)
-        self._model.to(self._device)
-        self._model.eval()
+        self._model = build_eval_model_from_path(self._model_path, self._device)
         print('model built on ', self._model.device)
 
     def _initialize_route_plan(self, route_roadblock_ids):
@@ -97,7 +95,8 @@ class Planner(AbstractPlanner):
             relative_traj[0, :] = trajectory_label_15s[iteration, :]
         else:
             # features = observation_adapter(history, traffic_light_data, self._map_api, self._route_roadblock_ids, self._device)
-            with torch.no_grad():
+            # the model caches inputs and outputs between calls, one inference at a time per model instance
+            with torch.no_grad(), eval_model_lock(self._model):
                 # print("start generating trajectory with gpu?", self.use_gpu)
                 if self._model.device != 'cpu':
                     device = self._model.device
@@ -6,9 +6,7 @@ import cv2
 import torch
 from shapely.geometry import LineString
 
-from transformers import HfArgumentParser
-from transformer4planning.utils.args import ModelArguments
-from transformer4planning.models.backbone.str_base import build_models
+from transformer4planning.models.backbone.str_base import build_eval_model_from_path, eval_model_lock
 
 from nuplan.common.actor_state.ego_state import EgoState
 from nuplan.common.actor_state.state_representation import Point2D
@@ -47,32 +45,8 @@ class STRTrajectoryGenerator:
     
     def _initialize_model(self):
         if self._build_model:
-            parser = HfArgumentParser((ModelArguments))
-            # load model args from config.json
-            config_path = os.path.join(self._model_path, "config.json")
-            if not os.path.exists(config_path):
-                print(
-                    "WARNING config.json not found in checkpoint path, using default model args ",
-                    config_path,
-                )
-                model_args = parser.parse_args_into_dataclasses(
-                    return_remaining_strings=True
-                )[0]
-            else:
-                (model_args,) = parser.parse_json_file(config_path, allow_extra_keys=True)
-                model_args.model_pretrain_name_or_path = self._model_path
-                model_args.model_name = model_args.model_name.replace(
-                    "scratch", "pretrained"
-                )
-            print(
-                "model loaded with args: ",
-                model_args,
-                model_args.model_name,
-                self._model_path,
-            )
-            self._model = build_models(model_args=model_args)
-            self._model.cuda()
-            self._model.eval()
+            # built once per process, the generators of later scenarios share the model
+            self._model = build_eval_model_from_path(self._model_path, "cuda")
             print("model built on ", self._model.device)
         else:
             print("model not built")
@@ -177,7 +151,8 @@ class STRTrajectoryGenerator:
         agents_rect_local = model_samples['agents_rect_local']  # batch_size, time_steps, max_agent_num, 4, 2 (x, y)
 
         # features = observation_adapter(history, traffic_light_data, self._map_api, self._route_roadblock_ids, self._device)
-        with torch.no_grad():
+        # the model caches inputs and outputs between calls, one inference at a time per model instance
+        with torch.no_grad(), eval_model_lock(self._model):
             device = self._model.device
             prediction_generation = self._model.generate(
                 context_actions=torch.tensor(model_samples["context_actions"]).to(
@@ -199,23 +174,9 @@ class STRTrajectoryGenerator:
             pred_traj = (
                 prediction_generation["traj_logits"].detach().cpu().float().numpy()
             )
-            def gpu_list_to_cpu_numpy(gpu_list):
-                """将 GPU 上的列表转换为 CPU 上的 NumPy 数组。
-
-                Args:
-                    gpu_list: GPU 上的 Python 列表，列表中的元素是 PyTorch 张量。
-
-                Returns:
-                    CPU 上的 NumPy 数组。
-                """
-                # 将列表中的所有张量移动到 CPU
-                cpu_tensors = [tensor.cpu() for tensor in gpu_list]
-                # 将张量列表转换为 NumPy 数组
-                cpu_numpy_array = np.array([tensor.numpy() for tensor in cpu_tensors])
-                return cpu_numpy_array
-
+            # one device to host copy for all samples
             traj_scores = (
-                gpu_list_to_cpu_numpy(prediction_generation["traj_scores"])
+                prediction_generation["traj_scores"].detach().cpu().float().numpy()
             )
 
             try:
@@ -231,14 +192,12 @@ class STRTrajectoryGenerator:
                 sin_, cos_ = np.sin(-oriented_yaws - math.pi / 2), np.cos(
                     -oriented_yaws - math.pi / 2
                 )
+                # broadcast the rotation of each sample over its trajectory
+                cos_ = cos_.reshape((batch_size,) + (1,) * (pred_traj.ndim - 2))
+                sin_ = sin_.reshape((batch_size,) + (1,) * (pred_traj.ndim - 2))
                 rotated_pred_traj = pred_traj.copy()
-                for i in range(batch_size):
-                    rotated_pred_traj[i, ..., 0] = (
-                        pred_traj[i, ..., 0] * cos_[i] - pred_traj[i, ..., 1] * sin_[i]
-                    )
-                    rotated_pred_traj[i, ..., 1] = (
-                        pred_traj[i, ..., 0] * sin_[i] + pred_traj[i, ..., 1] * cos_[i]
-                    )
+                rotated_pred_traj[..., 0] = pred_traj[..., 0] * cos_ - pred_traj[..., 1] * sin_
+                rotated_pred_traj[..., 1] = pred_traj[..., 0] * sin_ + pred_traj[..., 1] * cos_
                 pred_traj = rotated_pred_traj
 
         # post-processing
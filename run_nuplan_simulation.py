@@ -5,7 +5,7 @@ from pathlib import Path
 
 import hydra
 
-from nuplan.planning.script.run_simulation import (
+from tuplan_garage.run_simulation import (
     run_simulation as nuplan_run_simulation,
 )
 from nuplan.planning.script.builders.planner_builder import build_planners
@@ -4,24 +4,34 @@
 Train a Transformer ML Model for Planning
 """
 
+import atexit
+import gc
+import hashlib
 import logging
 import os
 import random
 import shutil
 import sys
+import threading
 import pickle
+import struct
 import copy
 import torch
 from tqdm import tqdm
-import copy
 import multiprocessing as mp
 import datasets
 import numpy as np
 import evaluate
 import transformers
 from datasets import Dataset
-from datasets.arrow_dataset import _concatenate_map_style_datasets
+from datasets import concatenate_datasets
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import json
+try:
+    import safetensors.numpy
+except ImportError:
+    safetensors = None
 
 from transformers import (
     HfArgumentParser,
@@ -35,43 +45,84 @@ from transformer4planning.utils.args import (
     ConfigArguments, 
     PlanningTrainingArguments
 )
-from transformers.trainer_utils import get_last_checkpoint
+from transformers.trainer_utils import get_last_checkpoint, HubStrategy
 from transformer4planning.trainer import (PlanningTrainer, CustomCallback)
 from torch.utils.data import DataLoader
+from torch.utils.data._utils.collate import default_collate
 from transformers.trainer_callback import DefaultFlowCallback
 from transformer4planning.trainer import compute_metrics
 
 from datasets import Dataset, Value
 
 # os.environ["WANDB_DISABLED"] = "true"
-os.environ['CUDA_LAUNCH_BLOCKING'] = "1"
+# export CUDA_LAUNCH_BLOCKING=1 to debug cuda errors, forcing it here serializes every kernel launch and copy
 # Will error if the minimal version of Transformers is not installed. Remove at your own risks.
 logger = logging.getLogger(__name__)
 
-def load_dataset(root, split='train', dataset_scale=1, agent_type="all", select=False):
-    datasets = []
+CONCAT_CACHE_FOLDER = '_concat_cache'
+
+
+def _concat_cache_key(split, index_paths):
+    # the sorted city folders with the modification times of their folder and state file, any added, removed or
+    # regenerated city gives a new key
+    stamps = []
+    for index_path in sorted(index_paths):
+        state_path = os.path.join(index_path, 'state.json')
+        state_mtime = os.stat(state_path).st_mtime_ns if os.path.exists(state_path) else 0
+        stamps.append("{}:{}:{}".format(os.path.basename(index_path), os.stat(index_path).st_mtime_ns, state_mtime))
+    return "{}-{}".format(split, hashlib.sha1("\n".join(stamps).encode()).hexdigest()[:16])
+
+
+def _load_concat_dataset(index_paths, concat_cache_path, write_cache):
+    if concat_cache_path is not None and os.path.isdir(concat_cache_path):
+        logger.info("Loading concatenated dataset {}".format(concat_cache_path))
+        return Dataset.load_from_disk(concat_cache_path)
+    # loading a dataset is mostly reading arrow metadata and mapping files, overlap the cities
+    with ThreadPoolExecutor(max_workers=min(16, len(index_paths))) as executor:
+        datasets = [dataset for dataset in executor.map(Dataset.load_from_disk, index_paths) if dataset is not None]
+    dataset = concatenate_datasets(datasets)
+    if concat_cache_path is not None and write_cache:
+        # write aside and rename, an interrupted save never leaves a partial cache
+        tmp_cache_path = "{}.{}".format(concat_cache_path, os.getpid())
+        try:
+            dataset.save_to_disk(tmp_cache_path)
+            os.rename(tmp_cache_path, concat_cache_path)
+        except OSError as e:
+            logger.warning("Could not save concatenated dataset cache {}: {}".format(concat_cache_path, e))
+            shutil.rmtree(tmp_cache_path, ignore_errors=True)
+    for each in datasets:
+        each.cleanup_cache_files()
+    return dataset
+
+
+def load_dataset(root, split='train', dataset_scale=1, agent_type="all", select=False, training_args=None,
+                 cache_concat=False):
+    """
+    With cache_concat, the concatenation of the city datasets is saved once to root/_concat_cache, outside of the
+    split folders, and later runs open that single dataset instead of every city. The main process loads first and
+    is the only one writing the cache, the other processes then load the cache it wrote.
+    """
     index_root_folders = os.path.join(root, split)
     indices = os.listdir(index_root_folders)
 
-    for index in indices:
-        index_path = os.path.join(index_root_folders, index)
-        if os.path.isdir(index_path):
-            # load training dataset
-            logger.info("Loading dataset {}".format(index_path))
-            dataset = Dataset.load_from_disk(index_path)
-            if dataset is not None:
-                datasets.append(dataset)
-        else:
-            continue
+    index_paths = [os.path.join(index_root_folders, index) for index in indices
+                   if os.path.isdir(os.path.join(index_root_folders, index))]
+    for index_path in index_paths:
+        logger.info("Loading dataset {}".format(index_path))
     # For nuplan dataset directory structure, each split obtains multi cities directories, so concat is required;
     # But for waymo dataset, index directory is just the datset, so load directory directly to build dataset. 
-    if len(datasets) > 0: 
-        dataset = _concatenate_map_style_datasets(datasets)
-        for each in datasets:
-            each.cleanup_cache_files()
+    if len(index_paths) > 0 and cache_concat:
+        concat_cache_path = os.path.join(root, CONCAT_CACHE_FOLDER, _concat_cache_key(split, index_paths))
+        with training_args.main_process_first(local=False, desc="loading {} dataset".format(split)):
+            dataset = _load_concat_dataset(index_paths, concat_cache_path, training_args.process_index == 0)
+    elif len(index_paths) > 0:
+        dataset = _load_concat_dataset(index_paths, None, False)
     else: 
         dataset = Dataset.load_from_disk(index_root_folders)
+    return _finalize_dataset(dataset, split, dataset_scale, agent_type, select)
 
+
+def _finalize_dataset(dataset, split, dataset_scale, agent_type, select):
     # add split column
     dataset.features.update({'split': Value('string')})
     try:
@@ -83,8 +134,6 @@ def load_dataset(root, split='train', dataset_scale=1, agent_type="all", select=
     except:
         pass
 
-    dataset.set_format(type='torch')
-
     if agent_type != "all":
         agent_type_list = agent_type.split()
         agent_type_list = [int(t) for t in agent_type_list]
@@ -94,7 +143,176 @@ def load_dataset(root, split='train', dataset_scale=1, agent_type="all", select=
         samples = int(len(dataset) * float(dataset_scale))
         dataset = dataset.select(range(samples))
 
-    return dataset
+    # set the torch format once on the final view, filtering above reads plain python rows instead of
+    # converting every example to tensors first
+    return dataset.with_format(type='torch')
+
+
+FEAT_COLLATE_KEYS = ('label', 'hidden_state')
+
+
+def feat_collate_func(batch, predict_yaw, keys=FEAT_COLLATE_KEYS):
+    # module level so that the partial can be pickled to spawned dataloader workers
+    result = {key: default_collate([d[key] for d in batch]) for key in keys}
+    if not predict_yaw and 'label' in result:
+        result['label'] = result['label'][..., :2]
+    return result
+
+
+# IOV_MAX of linux, the most buffers one writev accepts
+WRITEV_MAX_CHUNKS = 1024
+# results are saved on a background thread, pending saves are finished before the interpreter exits
+_SAVE_POOL = ThreadPoolExecutor(max_workers=1)
+atexit.register(_SAVE_POOL.shutdown, wait=True)
+
+
+def drop_written_pages(fd):
+    """
+    Flush the written file to disk and drop its pages from the page cache, results are not read back by this run
+    and would otherwise evict the cached dataset pages. The flush also makes the file durable before it is renamed.
+    """
+    os.fsync(fd)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def save_pickle_out_of_band(obj, path):
+    """
+    Pickle obj with protocol 5, contiguous array buffers are kept out-of-band and written after the pickle stream
+    instead of being copied into it. The file starts with the number of buffers and the byte lengths of the stream
+    and of every buffer, load it with load_pickle_out_of_band.
+    """
+    buffers = []
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    raw_buffers = [each_buffer.raw() for each_buffer in buffers]
+    lengths = [len(data)] + [each_raw.nbytes for each_raw in raw_buffers]
+    header = struct.pack('<Q{}Q'.format(len(lengths)), len(raw_buffers), *lengths)
+    # the header, the stream and all buffers go out in vectored writes instead of one write per piece
+    chunks = [memoryview(header), memoryview(data)] + [each_raw.cast('B') for each_raw in raw_buffers]
+    # written aside and renamed, readers never see a partially written file
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while chunks:
+            written = os.writev(fd, chunks[:WRITEV_MAX_CHUNKS])
+            # drop the chunks written completely and keep the tail of a partially written one
+            while chunks and written >= chunks[0].nbytes:
+                written -= chunks[0].nbytes
+                chunks.pop(0)
+            if written:
+                chunks[0] = chunks[0][written:]
+        drop_written_pages(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+
+
+def submit_save(save_func, obj, path):
+    future = _SAVE_POOL.submit(save_func, obj, path)
+
+    def log_failure(done_future):
+        if done_future.exception() is not None:
+            logger.error("Saving {} failed: {}".format(path, done_future.exception()))
+    future.add_done_callback(log_failure)
+    return future
+
+
+def save_dagger_results(result_list, path):
+    """
+    Save a dagger result dict of {file name: {metric: array}} as one safetensors file of the metric columns
+    concatenated over the files, the file names in order and their number of samples are kept in its metadata.
+    Falls back to save_pickle_out_of_band when safetensors is not installed or the dict is empty.
+    """
+    if safetensors is None or len(result_list) == 0:
+        save_pickle_out_of_band(result_list, path)
+        return
+    file_names = list(result_list.keys())
+    keys = list(result_list[file_names[0]].keys())
+    columns = {each_key: np.concatenate([np.asarray(result_list[each_name][each_key]) for each_name in file_names])
+               for each_key in keys}
+    base_path = os.path.splitext(path)[0]
+    # one self-contained file per result instead of a tensor file and an index file
+    metadata = dict(file_names=json.dumps(file_names),
+                    counts=json.dumps([len(result_list[each_name][keys[0]]) for each_name in file_names]))
+    # written aside and renamed, readers never see a partially written file
+    safetensors.numpy.save_file(columns, base_path + '.safetensors.tmp', metadata=metadata)
+    fd = os.open(base_path + '.safetensors.tmp', os.O_RDONLY)
+    try:
+        drop_written_pages(fd)
+    finally:
+        os.close(fd)
+    os.replace(base_path + '.safetensors.tmp', base_path + '.safetensors')
+
+
+def load_dagger_results(path):
+    base_path = os.path.splitext(path)[0]
+    if not os.path.exists(base_path + '.safetensors'):
+        return load_pickle_out_of_band(path)
+    with safetensors.safe_open(base_path + '.safetensors', framework='np') as handle:
+        metadata = handle.metadata()
+        columns = {each_key: handle.get_tensor(each_key) for each_key in handle.keys()}
+    offsets = np.cumsum([0] + json.loads(metadata['counts']))
+    return {each_name: {each_key: each_column[offsets[i]:offsets[i + 1]] for each_key, each_column in columns.items()}
+            for i, each_name in enumerate(json.loads(metadata['file_names']))}
+
+
+def load_pickle_out_of_band(path):
+    with open(path, 'rb') as handle:
+        num_buffers, = struct.unpack('<Q', handle.read(8))
+        lengths = struct.unpack('<{}Q'.format(num_buffers + 1), handle.read(8 * (num_buffers + 1)))
+        data = handle.read(lengths[0])
+        buffers = [bytearray(handle.read(each_length)) for each_length in lengths[1:]]
+    return pickle.loads(data, buffers=buffers)
+
+
+def upload_folder_to_hub(folder_path, repo_id, token=None, private=False, ignore_patterns=None):
+    """
+    Upload the folder with parallel http uploads, with hf_transfer when it is installed. Files matching
+    ignore_patterns are skipped, as Trainer.push_to_hub skips checkpoint folders.
+    """
+    import importlib.util
+    import huggingface_hub
+    if importlib.util.find_spec("hf_transfer") is not None:
+        os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+        # the hub constants are read at import, transformers has imported huggingface_hub already
+        huggingface_hub.constants.HF_HUB_ENABLE_HF_TRANSFER = True
+    hub_api = huggingface_hub.HfApi(token=token)
+    hub_api.create_repo(repo_id, private=private, exist_ok=True)
+    hub_api.upload_large_folder(folder_path=folder_path, repo_id=repo_id, repo_type="model",
+                                ignore_patterns=ignore_patterns, num_workers=max(1, os.cpu_count() - 1))
+    logger.info("Uploaded {} to {}".format(folder_path, repo_id))
+
+
+def prefetch_to_device(dataloader, device="cuda"):
+    """
+    Yield the batches of the dataloader moved to device. The copies of batch N+1 are issued on a side stream
+    while batch N is being computed, pin_memory of the dataloader is required for the copies to be asynchronous.
+    """
+    copy_stream = torch.cuda.Stream()
+
+    def to_device(batch):
+        with torch.cuda.stream(copy_stream):
+            for each_key, each_value in batch.items():
+                if torch.is_tensor(each_value):
+                    batch[each_key] = each_value.to(device, non_blocking=True)
+        return batch
+
+    iterator = iter(dataloader)
+    next_batch = next(iterator, None)
+    if next_batch is not None:
+        next_batch = to_device(next_batch)
+    while next_batch is not None:
+        current_stream = torch.cuda.current_stream()
+        current_stream.wait_stream(copy_stream)
+        batch = next_batch
+        for each_value in batch.values():
+            if torch.is_tensor(each_value):
+                # allocated on the copy stream, used on the current stream
+                each_value.record_stream(current_stream)
+        next_batch = next(iterator, None)
+        if next_batch is not None:
+            next_batch = to_device(next_batch)
+        yield batch
 
 
 def main():
@@ -186,9 +404,10 @@ def main():
     elif model_args.task == "train_diffusion_decoder":
         index_root = data_args.saved_dataset_folder
     root_folders = os.listdir(index_root)
+    load_split = partial(load_dataset, training_args=training_args, cache_concat=data_args.cache_concat_dataset)
 
     if 'train' in root_folders:
-        train_dataset = load_dataset(index_root, "train", data_args.dataset_scale, data_args.agent_type, True)
+        train_dataset = load_split(index_root, "train", data_args.dataset_scale, data_args.agent_type, True)
     else:
         raise ValueError("No training dataset found in {}, must include at least one city in /train".format(index_root))
 
@@ -197,13 +416,13 @@ def main():
 
     if training_args.do_test:
         assert 'test' in root_folders, f'No test dataset found in {root_folders}, cannot do test'
-        test_dataset = load_dataset(index_root, "test", data_args.dataset_scale, data_args.agent_type, False)
+        test_dataset = load_split(index_root, "test", data_args.dataset_scale, data_args.agent_type, False)
     else:
         test_dataset = None
 
     if (training_args.do_eval or training_args.do_predict):
         assert 'val' in root_folders, f'No val dataset found in {root_folders}, cannot do eval or predict'
-        val_dataset = load_dataset(index_root, "val", data_args.dataset_scale, data_args.agent_type, False)
+        val_dataset = load_split(index_root, "val", data_args.dataset_scale, data_args.agent_type, False)
         if model_args.camera_image_encoder is not None:
             val_dataset = val_dataset.filter(lambda example: len(example["images_path"]) == 8, num_proc=mp.cpu_count())
 
@@ -211,10 +430,10 @@ def main():
     if training_args.do_sim_val:
         # load val14_1k dataset for sim_val, 1118 samples in total
         assert 'val14_1k' in root_folders, f'No val14_1k dataset found in {root_folders}, cannot do sim_val'
-        val14_1k_dataset = load_dataset(index_root, "val14_1k", data_args.dataset_scale, data_args.agent_type, False)
+        val14_1k_dataset = load_split(index_root, "val14_1k", data_args.dataset_scale, data_args.agent_type, False)
     elif training_args.do_sim_test:
         assert 'test' in root_folders, f'No test dataset found in {root_folders}, cannot do sim_test'
-        val14_1k_dataset = load_dataset(index_root, "test_hard14_index", data_args.dataset_scale, data_args.agent_type, False)
+        val14_1k_dataset = load_split(index_root, "test_hard14_index", data_args.dataset_scale, data_args.agent_type, False)
 
 
     # clean image folders
@@ -307,10 +526,17 @@ def main():
     )
 
     # Load a model's pretrained weights from a path or from hugging face's model base
+    if model_args.skip_scratch_init and (not training_args.do_train or
+                                         (training_args.resume_from_checkpoint is None and last_checkpoint is None)):
+        raise ValueError("skip_scratch_init leaves the weights uninitialized, it requires resuming training from a checkpoint.")
     model = build_models(model_args)
     # use sync normal
     if model_args.sync_norm:
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    if model_args.compile_backbone:
+        # compile in place to keep the state dict keys of checkpoints unchanged
+        model.transformer.compile(mode="reduce-overhead")
+        logger.info('Backbone compiled with torch.compile, the first steps include compilation time')
 
     # clf_metrics = dict(
     #     accuracy=evaluate.load("accuracy"),
@@ -382,19 +608,6 @@ def main():
             raise NotImplementedError
         from transformer4planning.trainer import compute_metrics_waymo
     elif model_args.task == "train_diffusion_decoder":
-        from torch.utils.data._utils.collate import default_collate
-        def feat_collate_func(batch, predict_yaw):
-            excepted_keys = ['label', 'hidden_state']
-            result = dict()
-            for key in excepted_keys:
-                list_of_dvalues = []
-                for d in batch:
-                    if key in excepted_keys:
-                        if key == "label" and not predict_yaw:
-                            d[key] = d[key][:, :2]
-                        list_of_dvalues.append(d[key])
-                result[key] = default_collate(list_of_dvalues)
-            return result
         collate_fn = partial(feat_collate_func, predict_yaw=model_args.predict_yaw)
     else:
         raise AttributeError("task must be nuplan or waymo or train_diffusion_decoder")
@@ -478,7 +691,7 @@ def main():
         import safetensors
         TRAINING_ARGS_NAME = "training_args.bin"
         import types
-        def _save(self, output_dir: Optional[str] = None, state_dict=None):
+        def _save(self, output_dir: Optional[str] = None, state_dict=None, _internal_call=False):
             # If we are executing this function, we are the process zero, so we don't check for that.
             output_dir = output_dir if output_dir is not None else self.args.output_dir
             os.makedirs(output_dir, exist_ok=True)
@@ -523,7 +736,8 @@ def main():
     # Training
     if training_args.do_train:
         train_result = trainer.train(resume_from_checkpoint=checkpoint)
-        trainer.save_model()  # Saves the tokenizer too for easy upload
+        # Saves the tokenizer too for easy upload, the output folder is uploaded once at the end with push_to_hub
+        trainer.save_model(_internal_call=True)
         trainer.save_state()
 
     # Evaluation
@@ -569,7 +783,14 @@ def main():
         """
         # TODO: fit new online process pipeline to save dagger and prediction results
         logger.info("*** Predict ***")
-        with torch.no_grad():
+        model.eval()
+        # generate runs the backbone with a growing sequence length at every kv cache step
+        predict_with_generate = model_args.autoregressive or model_args.use_key_points is not None
+        if not model_args.compile_backbone and not predict_with_generate:
+            # the forward batches have a fixed shape with drop_last, the captured cuda graphs are replayed for every
+            # batch, generate would recompile and capture a new graph at every step instead
+            model.transformer.compile(mode="reduce-overhead", dynamic=False)
+        with torch.inference_mode():
             dagger_results = {
                 'file_name':[],
                 'frame_id':[],
@@ -587,45 +808,64 @@ def main():
             test_dataloader = DataLoader(
                 dataset=predict_dataset,
                 batch_size=training_args.per_device_eval_batch_size,
-                num_workers=training_args.per_device_eval_batch_size,
+                # share the cpus between the processes instead of one worker per sample of a batch
+                num_workers=min(8, max(1, os.cpu_count() // max(1, training_args.world_size))),
                 collate_fn=collate_fn,
                 pin_memory=True,
+                persistent_workers=True,
+                prefetch_factor=4,
                 drop_last=True
             )
 
 
+            # pinned host buffers with one slot per batch for the saved predictions, drop_last keeps every batch full,
+            # the trajectory buffer is allocated once the prediction shape is known
+            num_batches = len(test_dataloader)
+            frame_buffer = torch.full((num_batches, training_args.per_device_eval_batch_size), -1, dtype=torch.long, pin_memory=True)
+            trajectory_buffer = None
+
             if model_args.predict_trajectory:
-                end_bias_x = []
-                end_bias_y = []
-                all_bias_x = []
-                all_bias_y = []
-                losses = []
-
-            for itr, input in enumerate(tqdm(test_dataloader)):
-                # move batch to device
-                for each_key in input:
-                    if isinstance(input[each_key], type(torch.tensor(0))):
-                        input[each_key] = input[each_key].to("cuda")
+                # running sums of the loss, end point offsets, ADE and FDE kept on the device and read once at the end,
+                # per sample errors are only kept for dagger in a pinned host buffer with one slot per batch
+                error_sums = torch.zeros(5, dtype=torch.float64, device='cuda')
+                num_samples = 0
+                num_points = 0
+                if data_args.dagger:
+                    sample_errors = torch.empty((num_batches, training_args.per_device_eval_batch_size, 3), pin_memory=True)
 
+            # tensor core friendly half precision for the forward pass, generate has its own autocast option
+            autocast_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            # batches arrive on the device, the next one is copied while the current one is computed
+            for itr, input in enumerate(tqdm(prefetch_to_device(test_dataloader), total=len(test_dataloader))):
                 eval_batch_size = training_args.per_device_eval_batch_size
-                if model_args.autoregressive or model_args.use_key_points is not None:
+                if predict_with_generate:
                     # Todo: add autoregressive predict
                     traj_pred = model.generate(**input)
+                    # generate returns a dict of predictions, the trajectory is kept under traj_logits
+                    if isinstance(traj_pred, dict):
+                        traj_pred = traj_pred['traj_logits']
+                    traj_pred = traj_pred.float()
                 else:
-                    output = model(**copy.deepcopy(input))
-                    traj_pred = output.logits                   
-                    try:
-                        file_name = input['file_name']
-                        current_frame_idx = input['frame_id']
-                    except:
-                        file_name = ["null"] * eval_batch_size
-                        current_frame_idx = -1 * torch.ones(eval_batch_size)
-                    prediction_results['file_names'].extend(file_name)
-                    prediction_results['current_frame'].extend(current_frame_idx.cpu().numpy())
-                    if data_args.dagger:
-                        dagger_results['file_name'].extend(file_name)
-                        dagger_results['frame_id'].extend(list(current_frame_idx.cpu().numpy()))
-                
+                    # the model does not modify its inputs in eval mode, unpacking already gives it a new dict
+                    with torch.autocast(device_type='cuda', dtype=autocast_dtype):
+                        output = model(**input)
+                    # errors and losses below are reduced in fp32
+                    traj_pred = output.logits.float()
+                # file names, frame ids and predicted trajectories are recorded for both the generate and forward paths
+                try:
+                    file_name = input['file_name']
+                    current_frame_idx = input['frame_id']
+                except:
+                    file_name = ["null"] * eval_batch_size
+                    current_frame_idx = -1 * torch.ones(eval_batch_size)
+                prediction_results['file_names'].extend(file_name)
+                frame_buffer[itr].copy_(current_frame_idx, non_blocking=True)
+                if data_args.dagger:
+                    dagger_results['file_name'].extend(file_name)
+                if trajectory_buffer is None:
+                    trajectory_buffer = torch.empty((num_batches,) + tuple(traj_pred[..., :2].shape), pin_memory=True)
+                trajectory_buffer[itr].copy_(traj_pred[..., :2], non_blocking=True)
+
                 if model_args.predict_trajectory:
                     if model_args.autoregressive:# trajectory label as token case
                         trajectory_label = model.compute_normalized_points(input["trajectory"][:, 10:, :])
@@ -638,68 +878,73 @@ def main():
                         else:
                             trajectory_label = input["trajectory_label"][:, 1::2, :]
 
-                    loss = loss_fn(trajectory_label[:, :, :2], traj_pred[:, -trajectory_label.shape[1]:, :2])
-                    end_trajectory_label = trajectory_label[:, -1, :]
-                    end_point = traj_pred[:, -1, :]
-                    end_bias_x.append(end_trajectory_label[:, 0] - end_point[:, 0])
-                    end_bias_y.append(end_trajectory_label[:, 1] - end_point[:, 1])
-                    all_bias_x.append(trajectory_label[:, :, 0] - traj_pred[:, -trajectory_label.shape[1]:, 0])
-                    all_bias_y.append(trajectory_label[:, :, 1] - traj_pred[:, -trajectory_label.shape[1]:, 1])
-                    losses.append(loss)
+                    # the loss and all biases are derived from one difference tensor
+                    diff = trajectory_label[:, :, :2] - traj_pred[:, -trajectory_label.shape[1]:, :2]
+                    distance_error = diff.norm(dim=-1)
+                    # mean squared error of the x, y coordinates, end point x, y offsets, ADE and FDE sums, the end point
+                    # offsets of both coordinates are reduced together from a view of the last step of the difference
+                    error_sums += torch.cat([diff.pow(2).mean().view(1), diff[:, -1, :].abs().sum(dim=0),
+                                             distance_error.sum().view(1), distance_error[:, -1].sum().view(1)]).double()
+                    num_samples += diff.shape[0]
+                    num_points += distance_error.numel()
+                    if data_args.dagger:
+                        # per sample ADE, FDE and y bias, one asynchronous device to host copy per batch
+                        sample_errors[itr].copy_(torch.stack([distance_error.mean(dim=1), distance_error[:, -1],
+                                                              diff[..., 1].mean(dim=1)], dim=-1), non_blocking=True)
+
+            # wait for the pending copies into the host buffers
+            torch.cuda.synchronize()
+            current_frames = frame_buffer.reshape(-1).numpy()
+            if data_args.dagger:
+                dagger_results['frame_id'].extend(list(current_frames))
 
             if model_args.predict_trajectory:
-                end_bias_x = torch.stack(end_bias_x, 0).cpu().numpy()
-                end_bias_y = torch.stack(end_bias_y, 0).cpu().numpy()
-                all_bias_x = torch.stack(all_bias_x, 0).reshape(-1).cpu().numpy()
-                all_bias_y = torch.stack(all_bias_y, 0).reshape(-1).cpu().numpy()
-                final_loss = torch.mean(torch.stack(losses, 0)).item()
-                print('Mean L2 loss: ', final_loss)
-                print('End point x offset: ', np.average(np.abs(end_bias_x)))
-                print('End point y offset: ', np.average(np.abs(end_bias_y)))
-                distance_error = np.sqrt(np.abs(all_bias_x)**2 + np.abs(all_bias_y)**2).reshape(-1, 80)
-                final_distance_error = np.sqrt(np.abs(end_bias_x)**2 + np.abs(end_bias_y)**2)
+                # the only read of the running sums
+                final_loss, end_bias_x_sum, end_bias_y_sum, distance_error_sum, final_distance_error_sum = error_sums.tolist()
+                print('Mean L2 loss: ', final_loss / num_batches)
+                print('End point x offset: ', end_bias_x_sum / num_samples)
+                print('End point y offset: ', end_bias_y_sum / num_samples)
                 if data_args.dagger:
-                    dagger_results['ADE'].extend(list(np.average(distance_error, axis=1).reshape(-1)))
-                    dagger_results['FDE'].extend(list(final_distance_error.reshape(-1)))
-                    dagger_results['y_bias'].extend(list(np.average(all_bias_y.reshape(-1, 80), axis=1).reshape(-1)))
-                print('ADE', np.average(distance_error))
-                print('FDE', np.average(final_distance_error))
+                    sample_errors = sample_errors.reshape(-1, 3).numpy()
+                    dagger_results['ADE'].extend(list(sample_errors[:, 0]))
+                    dagger_results['FDE'].extend(list(sample_errors[:, 1]))
+                    dagger_results['y_bias'].extend(list(sample_errors[:, 2]))
+                print('ADE', distance_error_sum / num_points)
+                print('FDE', final_distance_error_sum / num_samples)
             
             # print(dagger_results)
             def compute_dagger_dict(dic):
-                tuple_list = list()
-                fde_result_list = dict()
-                y_bias_result_list = dict()
-                for filename, id, ade, fde, y_bias in zip(dic["file_name"], dic["frame_id"], dic["ADE"], dic["FDE"], dic["y_bias"]):
-                    if filename == "null":
-                        continue
-                    tuple_list.append((filename, id, ade, fde, abs(y_bias)))
-    
-                fde_sorted_list = sorted(tuple_list, key=lambda x:x[3], reverse=True)
-                for idx, tp in enumerate(fde_sorted_list): 
-                    if tp[0] in fde_result_list.keys():
-                        fde_result_list[tp[0]]["frame_id"].append(tp[1])
-                        fde_result_list[tp[0]]["ade"].append(tp[2])
-                        fde_result_list[tp[0]]["fde"].append(tp[3])
-                        fde_result_list[tp[0]]["y_bias"].append(tp[4])
-                        fde_result_list[tp[0]]["rank"].append((idx+1)/len(fde_sorted_list))
-                        
-                    else:
-                        fde_result_list[tp[0]] = dict(
-                            frame_id=[tp[1]], ade=[tp[2]], fde=[tp[3]], y_bias=[tp[4]], rank=[(idx+1)/len(fde_sorted_list)]
-                        )
-                y_bias_sorted_list = sorted(tuple_list, key=lambda x:x[-1], reverse=True)
-                for idx, tp in enumerate(y_bias_sorted_list): 
-                    if tp[0] in y_bias_result_list.keys():
-                        y_bias_result_list[tp[0]]["frame_id"].append(tp[1])
-                        y_bias_result_list[tp[0]]["ade"].append(tp[2])
-                        y_bias_result_list[tp[0]]["fde"].append(tp[3])
-                        y_bias_result_list[tp[0]]["y_bias"].append(tp[4])
-                        y_bias_result_list[tp[0]]["rank"].append((idx+1)/len(y_bias_sorted_list))
-                    else:
-                        y_bias_result_list[tp[0]] = dict(
-                            frame_id=[tp[1]], ade=[tp[2]], fde=[tp[3]], y_bias=[tp[4]], rank=[(idx+1)/len(y_bias_sorted_list)]
+                file_names = np.array(dic["file_name"])
+                valid = file_names != "null"
+                file_names = file_names[valid]
+                columns = dict(
+                    frame_id=np.array(dic["frame_id"])[valid], ade=np.array(dic["ADE"])[valid],
+                    fde=np.array(dic["FDE"])[valid], y_bias=np.abs(np.array(dic["y_bias"]))[valid]
+                )
+                ranks = np.arange(1, len(file_names) + 1) / max(len(file_names), 1)
+
+                def group_by_file(order):
+                    # order: indices sorted by the metric, descending, ties keep the input order as sorted() does
+                    if len(order) == 0:
+                        return dict()
+                    ranked_names = file_names[order]
+                    # rank positions grouped by file, np.unique returns the files in the same sorted order
+                    positions_by_file = np.argsort(ranked_names, kind="stable")
+                    unique_names, first_positions, counts = np.unique(ranked_names, return_index=True, return_counts=True)
+                    positions_of_each_file = np.split(positions_by_file, np.cumsum(counts)[:-1])
+                    result_list = dict()
+                    # files are inserted by their best rank
+                    for file_index in np.argsort(first_positions, kind="stable"):
+                        positions = positions_of_each_file[file_index]
+                        indices = order[positions]
+                        result_list[str(unique_names[file_index])] = dict(
+                            **{each_key: each_column[indices] for each_key, each_column in columns.items()},
+                            rank=ranks[positions]
                         )
+                    return result_list
+
+                fde_result_list = group_by_file(np.argsort(-columns["fde"], kind="stable"))
+                y_bias_result_list = group_by_file(np.argsort(-columns["y_bias"], kind="stable"))
                 return fde_result_list, y_bias_result_list
             
             def draw_histogram_graph(data, title, savepath):
@@ -709,26 +954,31 @@ def main():
                 plt.xlabel("Value")
                 plt.ylabel("Frequency")
                 plt.savefig(os.path.join(savepath, "{}.png".format(title)))
-            if data_args.dagger:
+            if data_args.dagger and trainer.is_world_process_zero():
                 draw_histogram_graph(dagger_results["FDE"], title="FDE-distributions", savepath=training_args.output_dir)
                 draw_histogram_graph(dagger_results["ADE"], title="ADE-distributions", savepath=training_args.output_dir)
                 draw_histogram_graph(dagger_results["y_bias"], title="ybias-distribution", savepath=training_args.output_dir)
                 fde_dagger_dic, y_bias_dagger_dic = compute_dagger_dict(dagger_results)
 
 
-            if training_args.output_dir is not None:
+            # every rank of a distributed run reaches this point, only the main process writes the result files
+            if training_args.output_dir is not None and trainer.is_world_process_zero():
                 # save results
                 output_file_path = os.path.join(training_args.output_dir, 'generated_predictions.pickle')
-                with open(output_file_path, 'wb') as handle:
+                # one array per numeric column, instead of pickling every numpy scalar of a list on its own
+                prediction_results['current_frame'] = current_frames
+                if trajectory_buffer is not None:
+                    prediction_results['predicted_trajectory'] = trajectory_buffer.reshape((-1,) + trajectory_buffer.shape[2:]).numpy()
+                with open(output_file_path, 'wb', buffering=16 << 20) as handle:
                     pickle.dump(prediction_results, handle, protocol=pickle.HIGHEST_PROTOCOL)
                 if data_args.dagger:
+                    # the per file metrics are arrays, saved as safetensors, load with load_dagger_results
+                    # the dicts are not touched afterwards, they are saved in the background without a copy
                     dagger_result_path = os.path.join(training_args.output_dir, "fde_dagger.pkl")
-                    with open(dagger_result_path, 'wb') as handle:
-                        pickle.dump(fde_dagger_dic, handle)
+                    submit_save(save_dagger_results, fde_dagger_dic, dagger_result_path)
                     dagger_result_path = os.path.join(training_args.output_dir, "ybias_dagger.pkl")
-                    with open(dagger_result_path, 'wb') as handle:
-                        pickle.dump(y_bias_dagger_dic, handle)
-                    print("dagger results save to {}".format(dagger_result_path))
+                    submit_save(save_dagger_results, y_bias_dagger_dic, dagger_result_path)
+                    print("dagger results save to {}".format(os.path.splitext(dagger_result_path)[0]))
 
         # predict_results = trainer.predict(predict_dataset, metric_key_prefix="predict")
         # metrics = predict_results.metrics
@@ -750,12 +1000,35 @@ def main():
         #         with open(output_prediction_file, "w") as writer:
         #             writer.write("\n".join(predictions))
 
-    kwargs = {"finetuned_from": model_args.model_pretrain_name_or_path, "tasks": "NuPlanPlanning"}
+    # the model card is written by the main process only, both with and without pushing to the hub
+    if trainer.is_world_process_zero():
+        kwargs = {"finetuned_from": model_args.model_pretrain_name_or_path, "tasks": "NuPlanPlanning"}
+        trainer.create_model_card(**kwargs)
 
     if training_args.push_to_hub:
-        trainer.push_to_hub(**kwargs)
-    else:
-        trainer.create_model_card(**kwargs)
+        # upload the output folder with parallel http uploads instead of the git based Trainer.push_to_hub,
+        # every rank takes part in saving the model, _internal_call keeps save_model from pushing on its own
+        trainer.save_model(_internal_call=True)
+        if trainer.is_world_process_zero():
+            repo_id = trainer.hub_model_id if getattr(trainer, "hub_model_id", None) else training_args.hub_model_id
+            # the checkpoint folders hold optimizer and scheduler states, they are only pushed for all_checkpoints
+            # the predict and dagger results written to the output folder are not part of the model either
+            ignore_patterns = ["_*", "generated_predictions.pickle", "*_dagger.*", "*-distribution*.png"]
+            if training_args.hub_strategy != HubStrategy.ALL_CHECKPOINTS:
+                ignore_patterns.append("checkpoint-*")
+            # the upload runs in the background while main returns, the thread is joined before the process exits
+            upload_thread = threading.Thread(target=upload_folder_to_hub, daemon=False,
+                                             args=(training_args.output_dir, repo_id, training_args.hub_token,
+                                                   training_args.hub_private_repo, ignore_patterns))
+            upload_thread.start()
+            atexit.register(upload_thread.join)
+
+    # release the trainer, the model and the cached cuda blocks before returning, the background saves and upload
+    # run until exit and the caller of main does not need them either
+    del trainer, model, dataset_dict
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
 
     return results
 
@@ -1,3 +1,4 @@
+import torch
 from transformer4planning.models.backbone.str_base import STR, STRConfig
 from transformers import (GPT2Model, GPT2PreTrainedModel, GPT2Config)
 
@@ -13,4 +14,7 @@ class STR_GPT2(STR, GPT2PreTrainedModel):
     """
     def __init__(self, config):
         super().__init__(config)
+        if hasattr(torch.nn.functional, "scaled_dot_product_attention") and getattr(GPT2Model, "_supports_sdpa", False):
+            # fused flash / memory efficient attention kernels instead of materializing the n x n attention matrix
+            config._attn_implementation = getattr(config, "attn_implementation", None) or "sdpa"
         self.transformer = GPT2Model(config)
@@ -12,6 +12,9 @@ class STRMambaConfig(STRConfig):
     pass
 
 class STRMamba(STR):
+    # mamba blocks are run without inference params, no cache to reuse
+    supports_kv_cache = False
+
     def __init__(self, config, **kwargs):
         super().__init__(config, **kwargs)
         # initialize mamba block
@@ -1,4 +1,8 @@
+import contextlib
 import copy
+import math
+import threading
+import weakref
 import torch
 import torch.nn as nn
 from typing import Tuple, Optional, Dict
@@ -9,11 +13,26 @@ from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 from transformers.configuration_utils import PretrainedConfig
 from transformers.modeling_utils import PreTrainedModel
 from transformers.utils import logging
+from transformer4planning.utils.checkpoint_utils import load_state_dict_into, prefetch_checkpoint_files, wait_for_prefetch
 
 logging.set_verbosity_info()
 logger = logging.get_logger("transformers")
 
 
+@contextlib.contextmanager
+def tf32_matmul():
+    """
+    TF32 tensor cores for the fp32 matmuls inside the context, the previous precision is restored on exit so that
+    training keeps full fp32 matmuls.
+    """
+    previous_precision = torch.get_float32_matmul_precision()
+    torch.set_float32_matmul_precision('high')
+    try:
+        yield
+    finally:
+        torch.set_float32_matmul_precision(previous_precision)
+
+
 @dataclass
 class LTMOutput(CausalLMOutputWithCrossAttentions):
     loss: Optional[torch.FloatTensor] = None
@@ -69,13 +88,19 @@ class STRConfig(PretrainedConfig):
                      "vit_intermediate_size", "mean_circular_loss",
                      "camera_image_encoder", "use_speed", "no_yaw_with_stepping", "autoregressive", "regression_long_class_short",
                      "kp_dropout", "traj_dropout", "trajectory_decoder_type",
-                     "output_router_logits", "skip_trajectory_decoding"]
+                     "output_router_logits", "skip_trajectory_decoding", "disable_vit_cudagraph",
+                     "skip_resnet_classifier", "generate_with_bf16_autocast",
+                     "diffusion_feature_shard", "checkpoint_direct_io", "checkpoint_load_workers",
+                     "convert_checkpoint_to_safetensors"]
         for each_attr in attr_list:
             if not hasattr(self, each_attr):
                 self.__dict__[each_attr] = False
 
 
 class STR(PreTrainedModel):
+    # whether the backbone accepts past_key_values for incremental decoding in generate
+    supports_kv_cache = True
+
     def __init__(self, config, **kwargs):
         super().__init__(config)
         self.config = config
@@ -123,6 +148,8 @@ class STR(PreTrainedModel):
             raise NotImplementedError
 
     def build_encoder(self):
+        # cached outputs of the previous encoder are invalid after rebuilding
+        self._zero_kp_embed = None
         if self.config.task == "nuplan":
             if "raster" in self.config.encoder_type:
                 if self.config.autoregressive:
@@ -171,9 +198,12 @@ class STR(PreTrainedModel):
                 from transformer4planning.models.decoder.diffusion_decoder import KeyPointDiffusionDecoder
                 self.key_points_decoder = KeyPointDiffusionDecoder(self.config)
                 if self.config.key_points_diffusion_decoder_load_from is not None:
-                    logger.info(f"Now loading pretrained key_points_diffusion_decoder from {self.config.key_points_diffusion_decoder_load_from}.")
-                    state_dict = torch.load(self.config.key_points_diffusion_decoder_load_from)
-                    self.key_points_decoder.model.load_state_dict(state_dict)
+                    logger.info('Now loading pretrained key_points_diffusion_decoder from %s.', self.config.key_points_diffusion_decoder_load_from)
+                    load_state_dict_into(self.key_points_decoder.model, self.config.key_points_diffusion_decoder_load_from,
+                                         direct_io=self.config.checkpoint_direct_io,
+                                         load_workers=self.config.checkpoint_load_workers,
+                                         convert_to_safetensors=self.config.convert_checkpoint_to_safetensors,
+                                         strict=False)
                     logger.info("Pretrained keypoint decoder has been loaded!")
                 else:
                     logger.info("Now initializing diffusion decoder from scratch. Training will consume lots of time.")
@@ -193,6 +223,24 @@ class STR(PreTrainedModel):
         if not self.config.skip_trajectory_decoding:
             self.traj_decoder = TrajectoryDecoder(self.config)
 
+    def train(self, mode: bool = True):
+        # weights are updated during training, drop embeddings cached at inference
+        self._zero_kp_embed = None
+        return super().train(mode)
+
+    def get_zero_key_point_embed(self, device):
+        """
+        Embedding of a zero key point as the placeholder of key points to generate.
+        It does not depend on the inputs, so compute once at inference and expand for each batch.
+        return `zero_kp_embed`: torch.Tensor, shape (1, 1, n_embed)
+        """
+        if self._zero_kp_embed is not None and self._zero_kp_embed.device == device:
+            return self._zero_kp_embed
+        zero_kp_embed = self.encoder.kps_m_embed(torch.zeros((1, 1, 2), device=device))
+        if not self.training and not torch.is_grad_enabled():
+            self._zero_kp_embed = zero_kp_embed
+        return zero_kp_embed
+
     def _prepare_attention_mask_for_generation(self, input_embeds):
         return torch.ones(input_embeds.shape[:2], dtype=torch.long, device=input_embeds.device)
 
@@ -216,31 +264,31 @@ class STR(PreTrainedModel):
 
         loss_items = {}
         pred_dict = {}
+        device = transformer_outputs_hidden_state.device
+        # loss terms are summed once at the end instead of accumulated in place into a zero tensor
+        loss_terms = []
 
         if self.config.autoregressive:
             frames_length_to_predict = info_dict["pred_length"]
             trajectory_label = info_dict['trajectory_label'][..., -frames_length_to_predict:, :]
-            loss = torch.tensor(0, dtype=input_embeds.dtype, device=transformer_outputs_hidden_state.device)
             traj_loss, traj_logits = self.traj_decoder.compute_traj_loss_autoregressive(transformer_outputs_hidden_state,
                                                                                         trajectory_label,
                                                                                         info_dict)
-            loss += traj_loss
+            loss_terms.append(traj_loss)
         else:
             trajectory_label = info_dict["trajectory_label"]
             if self.config.reverse_traj_index_order:
                 trajectory_label = trajectory_label.flip(-2)
-            loss = torch.tensor(0, dtype=input_embeds.dtype, device=transformer_outputs_hidden_state.device)
             frames_length_to_predict = trajectory_label.shape[1]
             if self.config.use_proposal:
                 if self.config.task == "waymo":
                     proposal_loss, proposal_loss_logits = self.proposal_decoder.compute_proposal_loss(transformer_outputs_hidden_state, info_dict)
-                    loss += proposal_loss
-                    loss += proposal_loss_logits
+                    loss_terms += [proposal_loss, proposal_loss_logits]
                     loss_items["proposal_loss"] = proposal_loss
                     pred_dict["proposal"] = proposal_loss_logits
                 elif self.config.task == "nuplan":
                     traj_loss = self.proposal_decoder.compute_traj_loss(transformer_outputs_hidden_state, info_dict)
-                    loss += traj_loss
+                    loss_terms.append(traj_loss)
                     loss_items["proposal_loss"] = traj_loss
                     # pred_dict["proposal"] = traj_logits
             if not self.config.skip_trajectory_decoding:
@@ -248,7 +296,7 @@ class STR(PreTrainedModel):
                                                                              trajectory_label,
                                                                              info_dict,
                                                                              **kwargs)
-                loss += traj_loss
+                loss_terms.append(traj_loss)
 
         loss_items.update(dict(traj_loss=traj_loss))
         pred_dict.update(dict(traj_logits=traj_logits))
@@ -259,7 +307,7 @@ class STR(PreTrainedModel):
 
         if self.config.dense_pred:
             assert self.config.task == "waymo"
-            loss += info_dict["dense_pred_loss"]
+            loss_terms.append(info_dict["dense_pred_loss"])
             loss_items["dense_pred_loss"] = info_dict["dense_pred_loss"]
 
         if self.use_key_points != 'no':
@@ -272,8 +320,10 @@ class STR(PreTrainedModel):
             if self.config.kp_decoder_type == "diffusion":
                 # assert not self.training, "please train diffusion decoder separately."
                 # return a dummy loss&kp_logits here. The real data for computing metrics will be computed in the generate function
-                kp_loss = torch.tensor(0.0).to(transformer_outputs_hidden_state.device)
-                kp_logits = info_dict["future_key_points"][..., :2].to(transformer_outputs_hidden_state.device)
+                kp_loss = torch.zeros((), device=device)
+                kp_logits = info_dict["future_key_points"][..., :2]
+                if kp_logits.device != device:
+                    kp_logits = kp_logits.to(device)
             elif self.config.kp_decoder_type == "linear":
                 kp_loss, kp_logits = self.key_points_decoder.compute_keypoint_loss(transformer_outputs_hidden_state, info_dict)
             else:
@@ -285,7 +335,7 @@ class STR(PreTrainedModel):
                 # padding last dimension from 2 to 4
                 kp_logits = torch.cat([kp_logits, torch.zeros_like(kp_logits)[:, :, :2]], dim=-1)
 
-            loss += kp_loss
+            loss_terms.append(kp_loss)
             traj_logits = torch.cat([kp_logits, traj_logits], dim=1)
             pred_dict["kp_logits"] = kp_logits
             loss_items["kp_loss"] = kp_loss
@@ -298,12 +348,16 @@ class STR(PreTrainedModel):
                 self.config.num_local_experts,
                 self.config.num_experts_per_token
             )
-            loss += self.config.router_aux_loss_coef * aux_loss.to(loss.device)  # make sure to reside in the same device
+            loss_terms.append(self.config.router_aux_loss_coef * aux_loss.to(device))  # make sure to reside in the same device
 
         # WIP: training with simulations
         if self.config.finetuning_with_simulation_on_val and self.training:
             sim_loss = self.do_closed_loop_simulation(kwargs)
-            loss += sim_loss
+            loss_terms.append(sim_loss)
+
+        loss = sum(loss_terms[1:], loss_terms[0]) if len(loss_terms) > 0 else torch.zeros((), dtype=input_embeds.dtype, device=device)
+        # loss items are only logged, do not keep the autograd graph alive through them
+        loss_items = {key: value.detach() if torch.is_tensor(value) else value for key, value in loss_items.items()}
 
         # if not return_dict:
         #     output = (traj_logits,) + transformer_outputs[1:]
@@ -326,6 +380,20 @@ class STR(PreTrainedModel):
         )
         return transformer_outputs
 
+    def embedding_to_hidden_with_cache(self, input_embeds, past_key_values=None, position_ids=None):
+        """
+        Forward the backbone reusing cached keys and values of the previous positions.
+        return the last hidden state of the input positions and the updated past_key_values
+        """
+        transformer_outputs = self.transformer(
+            inputs_embeds=input_embeds,
+            past_key_values=past_key_values,
+            position_ids=position_ids,
+            use_cache=True,
+            return_dict=True
+        )
+        return transformer_outputs['last_hidden_state'], transformer_outputs['past_key_values']
+
     def do_closed_loop_simulation(self,
                                   inputs,
                                   metric_key_prefix: str = "CLS", ):
@@ -394,8 +462,19 @@ class STR(PreTrainedModel):
         return sim_loss
 
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def generate(self, **kwargs) -> torch.FloatTensor:
+        # TF32 for the fp32 matmuls of inference only, convolutions already default to TF32
+        with tf32_matmul():
+            if not self.config.generate_with_bf16_autocast:
+                return self._generate(**kwargs)
+            with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16):
+                pred_dict = self._generate(**kwargs)
+        # return results in fp32, bf16 tensors can not be converted to numpy by the planners
+        return {key: value.float() if torch.is_tensor(value) and value.is_floating_point() else value
+                for key, value in pred_dict.items()}
+
+    def _generate(self, **kwargs) -> Dict:
         # first encode context
         input_embeds, info_dict = self.encoder(is_training=False, **kwargs)
         batch_size, _, _ = input_embeds.shape
@@ -427,27 +506,42 @@ class STR(PreTrainedModel):
         }
         """
 
+        # constants over the modes below, look up once per call
+        pred_length = info_dict.get("pred_length", 0)
+        if self.use_key_points != "no":
+            # the number of key points only depends on the configuration and the prediction length
+            if 'specified' in self.use_key_points:
+                key_points_num = len(self.encoder.selected_indices)
+            else:
+                ar_future_interval = 20
+                key_points_num = len(range(ar_future_interval - 1, pred_length, ar_future_interval))
+            assert key_points_num > 0, 'future points not enough to sample'
+        # pass the following infos during generate for one sample (non-batch) generate with KP checking
+        map_name = kwargs.get("map", None)
+        route_ids = kwargs.get("route_ids", None)
+        ego_pose = kwargs.get("ego_pose", None)
+        road_dic = kwargs.get("road_dic", None)
+
         for mode in range(select_k):
             kp_start_index = int(context_length)
+            # keys and values of the key point loop, reused to encode the trajectory part
+            past_key_values = None
             if self.config.use_proposal:
                 if self.config.task == 'waymo' and mode == 1:
                     dummy_proposal_embedding = self.encoder.proposal_m_embed(torch.zeros((batch_size,
                                                                                           2), device=device)).unsqueeze(1)
                     input_embeds[:, context_length:context_length + 1, :] = dummy_proposal_embedding
                     context_embeds = input_embeds[:, :context_length + 1, :]
-                    attention_mask = torch.ones(context_embeds.shape[:2], dtype=torch.long, device=device)
+                    # no padding in generation, the backbone defaults to the full causal mask and arange positions
                     transformer_outputs_hidden_state = self.embedding_to_hidden(
                         input_embeds=context_embeds,
-                        attention_mask=attention_mask,
-                        position_ids=self._prepare_position_ids_for_generation(attention_mask.clone())
                     )['last_hidden_state']
                     proposal_hidden_state = transformer_outputs_hidden_state[:,
                                             context_length - 1:context_length - 1 + 1, :]  # (bs, 1, n_embed)
                     proposal_pred_score = self.proposal_decoder.proposal_cls_decoder(proposal_hidden_state).softmax(-1)  # (bs, 1, 64/5)
                     proposal_logit = info_dict["center_obj_proposal_pts"]  # (bs, 64, 2)
                     topk_score, topk_indx = torch.topk(proposal_pred_score[:, 0, :], dim=-1, k=self.k)
-                    proposal_pred_logit = proposal_logit[torch.arange(batch_size)[:, None].repeat(1, self.k).view(-1),
-                                          topk_indx.view(-1), :].view(batch_size, self.k, 2)
+                    proposal_pred_logit = proposal_logit.gather(1, topk_indx.unsqueeze(-1).expand(-1, -1, 2))  # (bs, k, 2)
                     proposal_pred_embed = self.encoder.proposal_m_embed(proposal_pred_logit)
                     proposal_result = topk_indx
                     proposal_scores = proposal_pred_score[:, 0, :]
@@ -460,14 +554,10 @@ class STR(PreTrainedModel):
 
                     context_length = info_dict["context_length"]
                     candi_proposal_num = info_dict['candi_proposal_num']
-                    pred_length = info_dict.get("pred_length", 0)
                     context_length_with_proposal = context_length + candi_proposal_num
                     context_embeds = input_embeds[:, :context_length_with_proposal, :]
-                    attention_mask = torch.ones(context_embeds.shape[:2], dtype=torch.long, device=device)
                     transformer_outputs_hidden_state = self.embedding_to_hidden(
                         input_embeds=context_embeds,  # keep the dim the same as training for simplicity
-                        attention_mask=attention_mask,
-                        position_ids=self._prepare_position_ids_for_generation(attention_mask.clone())
                     )['last_hidden_state']
                     traj_logits, scores = self.proposal_decoder.generate_trajs(transformer_outputs_hidden_state, info_dict)
                     if self.config.reverse_traj_index_order:
@@ -483,55 +573,55 @@ class STR(PreTrainedModel):
                     proposal_scores = scores
 
             if self.use_key_points != "no":
-
-                selected_indices = self.encoder.selected_indices
                 # kp_start_index = int(context_length)  # Update: set before proposal
-
-                # pass the following infos during generate for one sample (non-batch) generate with KP checking
-                map_name = kwargs.get("map", None)
-                route_ids = kwargs.get("route_ids", None)
-                ego_pose = kwargs.get("ego_pose", None)
-                road_dic = kwargs.get("road_dic", None)
-
-                trajectory_label_dummy = torch.zeros((batch_size, pred_length, 4), device=device)
-                if 'specified' in self.use_key_points:
-                    future_key_points = trajectory_label_dummy[:, selected_indices, :]
-                else:
-                    ar_future_interval = 20
-                    future_key_points = trajectory_label_dummy[:, ar_future_interval - 1::ar_future_interval, :]
-
-                assert future_key_points.shape[1] > 0, 'future points not enough to sample'
-
                 if self.config.task == "nuplan":
                     if not self.config.separate_kp_encoder:
                         assert False, 'deprecated, use separate_kp_encoder instead'
+                        future_key_points = torch.zeros((batch_size, key_points_num, 4), device=device)
                         if self.config.use_speed:
                             # padding speed, padding the last dimension from 4 to 7
                             future_key_points = torch.cat([future_key_points,
                                                            torch.zeros_like(future_key_points)[:, :, :3]], dim=-1)
                         future_key_embeds_dummy = self.encoder.action_m_embed(future_key_points)
                     else:
-                        future_key_embeds_dummy = self.encoder.kps_m_embed(future_key_points[..., :2])
+                        future_key_embeds_dummy = self.get_zero_key_point_embed(device).expand(batch_size, key_points_num, -1)
                 else:
                     assert False, 'Key Point for waymo not implemented yet'
 
-                key_points_num = future_key_points.shape[1]
-
                 input_embeds[:, kp_start_index:kp_start_index + key_points_num, :] = future_key_embeds_dummy
-                pred_key_points_during_generate = []
+                # filled in place by each step of the loop below
+                key_points_logits = torch.empty((batch_size, key_points_num, 2), device=device)
+                use_kv_cache = self.supports_kv_cache and self.config.use_cache
                 for i in range(key_points_num):
-                    input_embeds_current = input_embeds[:, :kp_start_index + i, :]
-                    attention_mask = torch.ones(input_embeds_current.shape[
-                                                :2], dtype=torch.long, device=input_embeds.device)
-                    position_ids = self._prepare_position_ids_for_generation(attention_mask.clone())
-                    transformer_outputs_hidden_state = self.embedding_to_hidden(
-                        input_embeds_current,
-                        attention_mask,
-                        position_ids,
-                    )['last_hidden_state']
-                    future_key_point_hidden_state = transformer_outputs_hidden_state[:,
-                                                    kp_start_index + i - 1,
-                                                    :].reshape(batch_size, 1, -1)
+                    if use_kv_cache:
+                        # encode the context once, then only feed the key point predicted at the last step
+                        if past_key_values is None:
+                            input_embeds_current = input_embeds[:, :kp_start_index + i, :]
+                            position_ids = None
+                        else:
+                            input_embeds_current = input_embeds[:, kp_start_index + i - 1:kp_start_index + i, :]
+                            position_ids = torch.full((batch_size, 1), kp_start_index + i - 1, dtype=torch.long, device=device)
+                        transformer_outputs_hidden_state, past_key_values = self.embedding_to_hidden_with_cache(
+                            input_embeds_current,
+                            past_key_values,
+                            position_ids,
+                        )
+                        future_key_point_hidden_state = transformer_outputs_hidden_state[:, -1:, :]
+                        # keep hidden states of all encoded positions for the trajectory decoder
+                        if i == 0:
+                            hidden_state_buffer = transformer_outputs_hidden_state.new_empty(
+                                (batch_size, input_embeds.shape[1], transformer_outputs_hidden_state.shape[-1]))
+                            hidden_state_buffer[:, :kp_start_index, :] = transformer_outputs_hidden_state
+                        else:
+                            hidden_state_buffer[:, kp_start_index + i - 1, :] = future_key_point_hidden_state[:, 0, :]
+                    else:
+                        input_embeds_current = input_embeds[:, :kp_start_index + i, :]
+                        transformer_outputs_hidden_state = self.embedding_to_hidden(
+                            input_embeds_current,
+                        )['last_hidden_state']
+                        future_key_point_hidden_state = transformer_outputs_hidden_state[:,
+                                                        kp_start_index + i - 1,
+                                                        :].reshape(batch_size, 1, -1)
                     key_points_logit, _ = self.key_points_decoder.generate_keypoints(future_key_point_hidden_state)
                     # if self.kp_tokenizer is None:
                     #     key_points_logit, _ = self.key_points_decoder.generate_keypoints(future_key_point_hidden_state)
@@ -548,15 +638,12 @@ class STR(PreTrainedModel):
                         k_key_points_logit = key_points_logit['logits']  # (bs, 1, k, 2/4)
                         k_key_points_scores = key_points_logit['scores']  # (bs, 1, k)
                         _, seq_len, _, last_dim = k_key_points_logit.shape  # seq_len = 1 per key point
-                        selected_key_points = []
-                        for j in range(batch_size):
-                            selected_key_points_current_batch = []
-                            for k in range(seq_len):
-                                top_score, top_indx = torch.topk(k_key_points_scores[j, k, :], dim=-1, k=1)
-                                selected_key_points_current_batch.append(k_key_points_logit[j, k, top_indx[0], :])
-                            selected_key_points_current_batch = torch.stack(selected_key_points_current_batch, dim=0)
-                            selected_key_points.append(selected_key_points_current_batch)  # a list of (1, 2/4)
-                        key_points_logit = torch.stack(selected_key_points, dim=0)  # (bs, 1, 2/4)
+                        # select the top scored key point of each sample in one gather
+                        top_indx = k_key_points_scores.argmax(dim=-1)  # (bs, 1)
+                        key_points_logit = torch.gather(
+                            k_key_points_logit, 2,
+                            top_indx[:, :, None, None].expand(-1, -1, 1, last_dim)
+                        ).squeeze(2)  # (bs, 1, 2/4)
 
                     if gt_1s_kp is not None and i == 3:
                         # assert False, 'deprecated, debug only'
@@ -574,7 +661,8 @@ class STR(PreTrainedModel):
                             # Check key points with map_api
                             # WARNING: WIP, do not use
                             y_inverse = -1 if map_name[sample_index] == 'sg-one-north' else 1
-                            pred_key_point_copy = copy.deepcopy(pred_key_point[sample_index, 0, :2])
+                            # clone only copies the two elements, deepcopy of a view copies the whole storage
+                            pred_key_point_copy = pred_key_point[sample_index, 0, :2].clone()
                             pred_key_point_copy[1] *= y_inverse
                             pred_key_point_global = nuplan_utils.change_coordination(pred_key_point_copy[
                                                                                      :2].cpu().numpy(),
@@ -653,12 +741,23 @@ class STR(PreTrainedModel):
                         assert False, 'Key Point for waymo not implemented yet'
                     # replace embed at the next position
                     input_embeds[:, kp_start_index + i, :] = key_point_embed[:, 0, :]
-                    pred_key_points_during_generate.append(pred_key_point[:, 0, :2].unsqueeze(1))
-                key_points_logits = torch.cat(pred_key_points_during_generate, dim=1).reshape(batch_size, key_points_num, -1)
+                    key_points_logits[:, i, :] = pred_key_point[:, 0, :2]
                 key_points_logits_k.append(key_points_logits)
             pred_length = info_dict["pred_length"]
             # generate remaining trajectory
-            transformer_outputs_hidden_state = self.embedding_to_hidden(input_embeds)['last_hidden_state']
+            if past_key_values is not None:
+                # positions before the last key point are cached, only encode the rest
+                cached_length = kp_start_index + key_points_num - 1
+                position_ids = torch.arange(cached_length, input_embeds.shape[1], device=device).unsqueeze(0).expand(batch_size, -1)
+                remaining_hidden_state, _ = self.embedding_to_hidden_with_cache(
+                    input_embeds[:, cached_length:, :],
+                    past_key_values,
+                    position_ids,
+                )
+                hidden_state_buffer[:, cached_length:, :] = remaining_hidden_state
+                transformer_outputs_hidden_state = hidden_state_buffer
+            else:
+                transformer_outputs_hidden_state = self.embedding_to_hidden(input_embeds)['last_hidden_state']
             if self.config.autoregressive:
                 points_to_predict = info_dict["pred_length"]
                 raster_seq_length = info_dict["sequence_length"]
@@ -668,12 +767,8 @@ class STR(PreTrainedModel):
                     # 1. generate trajectory
                     current_context_length = context_length + i * (1 + raster_seq_length)  # input space index
                     context_embeds = input_embeds[:, :current_context_length, :]
-                    attention_mask = torch.ones(context_embeds.shape[:2], dtype=torch.long, device=device)
-                    position_ids = self._prepare_position_ids_for_generation(attention_mask.clone())
                     transformer_outputs_hidden_state = self.embedding_to_hidden(
                         context_embeds,
-                        attention_mask,
-                        position_ids,
                     )['last_hidden_state']
                     traj_logits[:, i, :] = self.traj_decoder.model(transformer_outputs_hidden_state)[:,
                                            predicting_index, :]
@@ -739,6 +834,8 @@ class STR(PreTrainedModel):
 
             from transformer4planning.utils import nuplan_utils
             any_point_off_road = [0] * batch_size
+            # read all predictions back at once, points are only revised after they are checked
+            traj_pred_xy = traj_pred_logits[..., :2].float().cpu().numpy()
             for sample_index in range(batch_size):
                 y_inverse = -1 if map_name[sample_index] == 'sg-one-north' else 1
                 if isinstance(route_ids[sample_index], torch.Tensor):
@@ -752,21 +849,27 @@ class STR(PreTrainedModel):
                 else:
                     print('testing: ', ego_pose.shape, ego_pose)
                     ego_center = ego_pose[sample_index]
-                for i in range(0, traj_pred_logits.shape[1], 2):
-                    pred_t = traj_pred_logits[sample_index, i, :2].float().cpu().numpy()
-                    pred_t[1] *= y_inverse
-                    try:
-                        pred_t_global = nuplan_utils.change_coordination(pred_t,
-                                                                         ego_center,
-                                                                         ego_to_global=True)
-                    except Exception as e:
-                        print('Failed to center on gen for dense chacking: ', pred_t, ego_center)
-                        continue
-
+                # rotation of this ego pose, shared by all points: global = R @ ego + t, ego = R^T @ (global - t)
+                try:
+                    cos_, sin_ = math.cos(ego_center[-1]), math.sin(ego_center[-1])
+                    ego_rotation = np.array([[cos_, -sin_], [sin_, cos_]])
+                    ego_translation = np.asarray(ego_center[:2], dtype=np.float64)
+                    pred_traj_ego = traj_pred_xy[sample_index, ::2].astype(np.float64)
+                    pred_traj_ego[:, 1] *= y_inverse
+                    pred_traj_global = pred_traj_ego @ ego_rotation.T + ego_translation
+                except Exception as e:
+                    print('Failed to center on gen for dense chacking: ', traj_pred_xy[sample_index, ::2], ego_center)
+                    continue
+                revised_pred_traj = None
+                # all points of this trajectory query the same route
+                route_cache = {}
+                for point_index, i in enumerate(range(0, traj_pred_logits.shape[1], 2)):
+                    pred_t_global = pred_traj_global[point_index]
                     closest_lane_point_on_route, dist, _, _, on_road = nuplan_utils.get_closest_lane_point_on_route(pred_t_global,
                                                                                                                     route_ids_this_sample,
                                                                                                                     road_dic[
-                                                                                                                        sample_index])
+                                                                                                                        sample_index],
+                                                                                                                    route_cache=route_cache)
                     if on_road is None and closest_lane_point_on_route is None:
                         break
                     if not on_road and i == 0:
@@ -774,16 +877,17 @@ class STR(PreTrainedModel):
                         break
                     if not on_road or any_point_off_road[sample_index]:
                         # if previous point off road, replace with the closest point on road
-                        revised_pred_point = closest_lane_point_on_route
-                        pred_t_ego_revised = nuplan_utils.change_coordination(revised_pred_point,
-                                                                              ego_center,
-                                                                              ego_to_global=False)
+                        pred_t_ego_revised = (np.asarray(closest_lane_point_on_route[:2], dtype=np.float64) - ego_translation) @ ego_rotation
                         pred_t_ego_revised[1] *= y_inverse
-                        traj_pred_logits[sample_index, i,
-                        :2] = torch.tensor(pred_t_ego_revised, device=traj_pred_logits.device)
+                        if revised_pred_traj is None:
+                            revised_pred_traj = traj_pred_xy[sample_index].copy()
+                        revised_pred_traj[i] = pred_t_ego_revised
                         if not on_road and not any_point_off_road[sample_index]:
                             print(f'Dense off Road Detected! Replace {i}th point and all followings')
                         any_point_off_road[sample_index] = 1
+                if revised_pred_traj is not None:
+                    # write all revised points of this sample back in one copy
+                    traj_pred_logits[sample_index, :, :2] = torch.from_numpy(revised_pred_traj).to(traj_pred_logits.device)
             any_point_off_road = torch.tensor(any_point_off_road, device=traj_pred_logits.device)
 
         emergency_brake_checking = False
@@ -873,47 +977,90 @@ class STR(PreTrainedModel):
         return pred_dict
 
 
+def _init_scratch(ModelCls, config_p, tag, model_args):
+    if model_args.skip_scratch_init:
+        # build the parameters on the meta device, buffers like the diffusion schedules are still computed
+        from accelerate import init_empty_weights
+        with init_empty_weights(include_buffers=False):
+            model = ModelCls(config_p)
+        materialized = {}
+        for each_module in model.modules():
+            for name, param in each_module.named_parameters(recurse=False):
+                if param.device.type != 'meta':
+                    continue
+                if id(param) not in materialized:
+                    # the weights are restored from the resumed checkpoint, skip the random init
+                    materialized[id(param)] = torch.nn.Parameter(torch.empty_like(param, device='cpu'), requires_grad=param.requires_grad)
+                each_module._parameters[name] = materialized[id(param)]
+        logger.info('Scratch %s allocated without initialization!', tag)
+        return model
+    model = ModelCls(config_p)
+    logger.info('Scratch %s Initialized!', tag)
+    return model
+
+
+def _init_pretrain(ModelCls, config_p, tag, model_args):
+    # from transformers import AqlmConfig
+    # quantization_config = AqlmConfig(weights="int8", pre_quantized=False)
+    # warm up the page cache with all weight files in parallel, overlapped with building the model below
+    # a decoder read with O_DIRECT does not go through the page cache
+    prefetch_futures = prefetch_checkpoint_files([model_args.model_pretrain_name_or_path,
+                                                  None if model_args.checkpoint_direct_io else model_args.key_points_diffusion_decoder_load_from],
+                                                 wait=False)
+    # build the modules on the meta device and materialize them from the checkpoint, instead of random init + copy
+    model = ModelCls.from_pretrained(model_args.model_pretrain_name_or_path, config=config_p, low_cpu_mem_usage=True)
+    logger.info('Pretrained %s from %s', tag, model_args.model_pretrain_name_or_path)
+    wait_for_prefetch(prefetch_futures)
+    if model_args.key_points_diffusion_decoder_load_from is not None:
+        logger.info('Now loading pretrained key_points_diffusion_decoder from %s.', model_args.key_points_diffusion_decoder_load_from)
+        load_state_dict_into(model.key_points_decoder.model, model_args.key_points_diffusion_decoder_load_from,
+                             direct_io=model_args.checkpoint_direct_io,
+                             load_workers=model_args.checkpoint_load_workers,
+                             convert_to_safetensors=model_args.convert_checkpoint_to_safetensors,
+                             strict=False)
+    return model
+
+
+def _init_transfer(ModelCls, config_p, tag, model_args):
+    model = ModelCls(config_p)
+    logger.info('Transfer %s from %s', tag, model_args.model_pretrain_name_or_path)
+    return model
+
+
+# part of the model name -> how the weights are initialized, checked in order
+MODEL_INIT_STRATEGIES = {
+    'scratch': _init_scratch,
+    'pretrain': _init_pretrain,
+    'transfer': _init_transfer,
+}
+# backbone family in the model name, checked in order, e.g. 'scratch-mixtral-small' -> 'mixtral'
+MODEL_FAMILIES = ('gpt', 'mamba', 'mixtral', 'stablelm')
+
+
+# model name -> (n_layer, n_embd, n_head) of the GPT2 backbone, n_inner is 4 * n_embd
+GPT2_PRESETS = {
+    'gpt-mini': (1, 64, 1),  # Number of parameters: 300k
+    'gpt-small': (4, 256, 8),  # Number of parameters: 16M
+    'gpt-medium': (12, 768, 12),  # Number of parameters: 124M
+    'gpt-large': (48, 1600, 25),  # Number of parameters: 1.5B
+}
+
+
 def build_models(model_args):
     # TODO: refactor model building function into each model class
-    if 'gpt' in model_args.model_name:
+    model_family = next((each_family for each_family in MODEL_FAMILIES if each_family in model_args.model_name), None)
+    if model_family == 'gpt':
         from transformer4planning.models.backbone.gpt2 import STR_GPT2, STRGPT2Config
         config_p = STRGPT2Config()
         config_p.update_by_model_args(model_args)
         # from transformer4planning.models.backbone.gpt2 import TrajectoryGPT
         ModelCls = STR_GPT2
         tag = 'GPTTrajectory'
-        if 'gpt-mini' in model_args.model_name:
-            """
-            Number of parameters: 300k
-            """
-            config_p.n_layer = 1
-            config_p.n_embd = config_p.d_model = 64
-            config_p.n_inner = config_p.n_embd * 4
-            config_p.n_head = 1
-        elif 'gpt-small' in model_args.model_name:
-            """
-            Number of parameters: 16M
-            """
-            config_p.n_layer = 4
-            config_p.n_embd = config_p.d_model = 256
+        preset = next((each_preset for each_name, each_preset in GPT2_PRESETS.items() if each_name in model_args.model_name), None)
+        if preset is not None:
+            config_p.n_layer, config_p.n_embd, config_p.n_head = preset
+            config_p.d_model = config_p.n_embd
             config_p.n_inner = config_p.n_embd * 4
-            config_p.n_head = 8
-        elif 'gpt-medium' in model_args.model_name:
-            """
-            Number of parameters: 124M
-            """
-            config_p.n_layer = 12
-            config_p.n_embd = config_p.d_model = 768
-            config_p.n_inner = config_p.n_embd * 4
-            config_p.n_head = 12
-        elif 'gpt-large' in model_args.model_name:
-            """
-            Number of parameters: 1.5B
-            """
-            config_p.n_layer = 48
-            config_p.n_embd = config_p.d_model = 1600
-            config_p.n_inner = config_p.n_embd * 4
-            config_p.n_head = 25
         else:
             logger.warning('Using default GPT2 config')
             config_p.n_layer = model_args.n_layers
@@ -934,13 +1081,15 @@ def build_models(model_args):
                                                      feat_dim=model_args.key_points_diffusion_decoder_feat_dim,)
             model = T4PTrainDiffWrapper(diffusion_model, num_key_points=model_args.key_points_num, model_args=config_p)
             if model_args.key_points_diffusion_decoder_load_from is not None:
-                state_dict = torch.load(model_args.key_points_diffusion_decoder_load_from)
-                model.load_state_dict(state_dict)
+                load_state_dict_into(model, model_args.key_points_diffusion_decoder_load_from,
+                                     direct_io=model_args.checkpoint_direct_io,
+                                     load_workers=model_args.checkpoint_load_workers,
+                                     convert_to_safetensors=model_args.convert_checkpoint_to_safetensors)
                 logger.info("Pretrained keypoint decoder has been loaded!")
             logger.info("Only diffusion decoder will be trained!")
             return model
         # whole model training
-    elif 'mamba' in model_args.model_name:
+    elif model_family == 'mamba':
         from transformer4planning.models.backbone.mamba import STRMamba, STRMambaConfig
         config_p = STRMambaConfig()
         config_p.update_by_model_args(model_args)
@@ -987,7 +1136,7 @@ def build_models(model_args):
             config_p.n_embd = config_p.d_model = 2048
             config_p.n_inner = config_p.n_embd * 4
             config_p.n_head = 32
-    elif 'mixtral' in model_args.model_name:
+    elif model_family == 'mixtral':
         from transformer4planning.models.backbone.mixtral import STR_Mixtral, STRMixtralConfig
         config_p = STRMixtralConfig()
         config_p.update_by_model_args(model_args)
@@ -1103,7 +1252,7 @@ def build_models(model_args):
             config_p.num_attention_heads = config_p.n_head
         else:
             assert False, f'Unsupported model name: {model_args.model_name}!'
-    elif 'stablelm' in model_args.model_name:
+    elif model_family == 'stablelm':
         from transformer4planning.models.backbone.stablelm import STR_StableLM, STRStableLMConfig
         config_p = STRStableLMConfig()
         config_p.update_by_model_args(model_args)
@@ -1163,22 +1312,11 @@ def build_models(model_args):
     else:
         raise ValueError("Model name must choose from ['scratch', 'pretrain'] + ['nonauto-gpt', 'transxl', 'gpt', 'xlnet']!")
 
-    if 'scratch' in model_args.model_name:
-        model = ModelCls(config_p)
-        logger.info('Scratch ' + tag + ' Initialized!')
-    elif 'pretrain' in model_args.model_name:
-        # from transformers import AqlmConfig
-        # quantization_config = AqlmConfig(weights="int8", pre_quantized=False)
-        model = ModelCls.from_pretrained(model_args.model_pretrain_name_or_path, config=config_p)
-        logger.info('Pretrained ' + tag + ' from {}'.format(model_args.model_pretrain_name_or_path))
-        if model_args.key_points_diffusion_decoder_load_from is not None:
-                print(f"Now loading pretrained key_points_diffusion_decoder from {model_args.key_points_diffusion_decoder_load_from}.")
-                state_dict = torch.load(model_args.key_points_diffusion_decoder_load_from)
-                model.key_points_decoder.model.load_state_dict(state_dict)
-    elif 'transfer' in model_args.model_name:
-        model = ModelCls(config_p)
-        logger.info('Transfer' + tag + ' from {}'.format(model_args.model_pretrain_name_or_path))
-    return model
+    init_strategy = next((each_strategy for each_name, each_strategy in MODEL_INIT_STRATEGIES.items()
+                          if each_name in model_args.model_name), None)
+    if init_strategy is None:
+        raise ValueError(f"Model name must contain one of {list(MODEL_INIT_STRATEGIES.keys())}, got {model_args.model_name}!")
+    return init_strategy(ModelCls, config_p, tag, model_args)
 
 
 def build_model_from_path(model_path, load_checkpoint=True):
@@ -1189,7 +1327,7 @@ def build_model_from_path(model_path, load_checkpoint=True):
     # load model args from config.json
     config_path = os.path.join(model_path, 'config.json')
     if not os.path.exists(config_path):
-        print('WARNING config.json not found in checkpoint path, using default model args ', config_path)
+        logger.warning('config.json not found in checkpoint path, using default model args %s', config_path)
         model_args = parser.parse_args_into_dataclasses(return_remaining_strings=True)[0]
     else:
         model_args, = parser.parse_json_file(config_path, allow_extra_keys=True)
@@ -1201,6 +1339,44 @@ def build_model_from_path(model_path, load_checkpoint=True):
     return model
 
 
+# (model path, device, thread id) -> model in eval mode, shared by the planners of the scenarios simulated in one thread
+_EVAL_MODEL_CACHE = {}
+_EVAL_MODEL_CACHE_LOCK = threading.Lock()
+
+
+def build_eval_model_from_path(model_path, device):
+    """
+    Build the model at model_path on device in eval mode once per thread, later calls from the same thread with the
+    same path and device return the same instance instead of constructing and loading the whole model again for
+    every scenario. The model keeps per call state (the raster CUDA graph buffers, the proposal and key point
+    embedding caches), so threads of a thread pool worker never share an instance and a planner must be used from
+    the thread that built it. Wrap inference in eval_model_lock for planners that may be used across threads.
+    """
+    import os
+    cache_key = (os.path.abspath(model_path), str(device), threading.get_ident())
+    with _EVAL_MODEL_CACHE_LOCK:
+        model = _EVAL_MODEL_CACHE.get(cache_key)
+    if model is None:
+        model = build_model_from_path(model_path)
+        model.to(device)
+        model.eval()
+        with _EVAL_MODEL_CACHE_LOCK:
+            _EVAL_MODEL_CACHE[cache_key] = model
+    return model
+
+
+_EVAL_MODEL_LOCKS = weakref.WeakKeyDictionary()
+
+
+def eval_model_lock(model):
+    """
+    The lock serializing the inference calls on model, kept outside of the module so that the model stays
+    copyable and picklable.
+    """
+    with _EVAL_MODEL_CACHE_LOCK:
+        return _EVAL_MODEL_LOCKS.setdefault(model, threading.Lock())
+
+
 def interpolate_yaw(pred_traj, mode, yaw_change_upper_threshold=0.1):
     # deprecated
     if mode == "normal":
@@ -1211,11 +1387,12 @@ def interpolate_yaw(pred_traj, mode, yaw_change_upper_threshold=0.1):
         # generating yaw angle from relative_traj
         dx = pred_traj[:, 4::5, 0] - pred_traj[:, :-4:5, 0]
         dy = pred_traj[:, 4::5, 1] - pred_traj[:, :-4:5, 1]
-        distances = torch.sqrt(dx ** 2 + dy ** 2)
-        relative_yaw_angles = torch.where(distances > 0.1, torch.arctan2(dy, dx), 0)
+        distances = torch.hypot(dx, dy)
+        relative_yaw_angles = torch.where(distances > 0.1, torch.atan2(dy, dx), 0)
         # accumulate yaw angle
         # relative_yaw_angles = yaw_angles.cumsum()
-        relative_yaw_angles_full = relative_yaw_angles.repeat_interleave(5, dim=1)
+        # broadcast each yaw to its 5 frames, equal to repeat_interleave(5, dim=1)
+        relative_yaw_angles_full = relative_yaw_angles.unsqueeze(-1).expand(-1, -1, 5).reshape(relative_yaw_angles.shape[0], -1)
         if mode == "interplate":
             pred_traj[:, :, -1] = relative_yaw_angles_full
         else:
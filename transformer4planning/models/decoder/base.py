@@ -4,6 +4,11 @@ from typing import Dict
 from transformer4planning.libs.mlp import DecoderResCat
 from torch.nn import CrossEntropyLoss, MSELoss
 import os
+import json
+import threading
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 # from transformers.utils import logging
 # logging.set_verbosity_info()
 # logger = logging.get_logger("transformers")
@@ -42,6 +47,64 @@ def normalize_angles(angles):
     return torch.atan2(torch.sin(angles), torch.cos(angles))
 
 
+class _FeatureSaver:
+    """
+    Background writer of the features dumped by KeyPointMLPDeocder.save_features, kept outside of the modules so that
+    the models stay copyable and picklable. At most max_pending saves are in flight, submitting more waits for the
+    oldest one, and the pinned staging buffers of finished saves are reused by the next copies of the same shape.
+    """
+    def __init__(self, max_workers=2, max_pending=8):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.shard_lock = threading.Lock()
+        self._executor = None
+        self._pending = collections.deque()
+        self._free_buffers = collections.defaultdict(list)
+        self._buffer_lock = threading.Lock()
+
+    def copy_to_pinned_cpu(self, tensor):
+        if not tensor.is_cuda:
+            return tensor.cpu()
+        buffer_key = (tuple(tensor.shape), tensor.dtype)
+        with self._buffer_lock:
+            free_buffers = self._free_buffers[buffer_key]
+            tensor_cpu = free_buffers.pop() if free_buffers else None
+        if tensor_cpu is None:
+            tensor_cpu = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        tensor_cpu.copy_(tensor, non_blocking=True)
+        return tensor_cpu
+
+    def _release_buffers(self, *tensors):
+        with self._buffer_lock:
+            for each_tensor in tensors:
+                if each_tensor.is_pinned():
+                    self._free_buffers[(tuple(each_tensor.shape), each_tensor.dtype)].append(each_tensor)
+
+    def submit(self, save_func, hidden_state_batch, key_points_batch, *args):
+        while len(self._pending) >= self.max_pending:
+            self._pending.popleft().result()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        def save():
+            try:
+                save_func(hidden_state_batch, key_points_batch, *args)
+            finally:
+                # the save functions copy what they write, the staging buffers are free once they return
+                self._release_buffers(hidden_state_batch, key_points_batch)
+        self._pending.append(self._executor.submit(save))
+
+    def wait(self):
+        """
+        Block until all submitted saves are written, re-raise errors of the writers.
+        """
+        while self._pending:
+            self._pending.popleft().result()
+
+
+_FEATURE_SAVER = _FeatureSaver()
+
+
 class TrajectoryDecoder(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -437,8 +500,9 @@ class TrajDecoderCLS(nn.Module):
         proposal_ids = proposal_id_scores.argmax(dim=-1)
         pred_trajs = self.traj_tokenizer.decode(proposal_ids)
         # padding z, from x, y, yaw to x, y, z, yaw
-        zeros_tensor = torch.zeros([pred_trajs.shape[0], pred_trajs.shape[1], 1]).to(pred_trajs.device)
-        pred_trajs_total = torch.cat((pred_trajs[ :, :, :2], zeros_tensor, pred_trajs[ :, :, 2:]), dim=-1)
+        pred_trajs_total = pred_trajs.new_zeros((pred_trajs.shape[0], pred_trajs.shape[1], 4))
+        pred_trajs_total[:, :, :2] = pred_trajs[:, :, :2]
+        pred_trajs_total[:, :, 3:] = pred_trajs[:, :, 2:]
         # key_point_logits = self.tokenizer.decode(key_point_id)  # b, s=1, 2
         return pred_trajs_total, proposal_id_scores
 
@@ -473,18 +537,17 @@ class KeyPointMLPDeocder(nn.Module):
             self.save_training_diffusion_feature_dir = os.path.join(self.config.diffusion_feature_save_dir,'train/')
             self.save_testing_diffusion_feature_dir = os.path.join(self.config.diffusion_feature_save_dir,'val/')
             self.save_test_diffusion_feature_dir = os.path.join(self.config.diffusion_feature_save_dir,'test/')
-            if not os.path.exists(self.save_training_diffusion_feature_dir):
-                os.makedirs(self.save_training_diffusion_feature_dir)
-            if not os.path.exists(self.save_testing_diffusion_feature_dir):
-                os.makedirs(self.save_testing_diffusion_feature_dir)
-            if not os.path.exists(self.save_test_diffusion_feature_dir):
-                os.makedirs(self.save_test_diffusion_feature_dir)
+            for each_dir in (self.save_training_diffusion_feature_dir, self.save_testing_diffusion_feature_dir, self.save_test_diffusion_feature_dir):
+                # exist_ok also avoids the race of several DDP ranks creating the same directory
+                os.makedirs(each_dir, exist_ok=True)
             self.current_idx = 0
             self.gpu_device_count = torch.cuda.device_count()
             # Notice that although we check and create two directories (train/ and test/) here, in the forward method we only save features in eval loops.
             # This is because evaluation is way faster than training (since there are no backward propagation), and after saving features for evaluation, we just change our test set to training set and then run the evaluation loop again.
             # The related code can be found in runner.py at around line 511.
             self.current_idx = 0
+            # features are written to disk on the background threads of _FEATURE_SAVER, call wait_for_saved_features
+            # before reading them
 
     def compute_keypoint_loss(self,
                               hidden_output,
@@ -530,7 +593,7 @@ class KeyPointMLPDeocder(nn.Module):
                 select_logtis = []
                 for i in range(future_key_points.shape[1]):
                     # repeat gt k times
-                    gt = future_key_points[:, i, :].unsqueeze(1).repeat(1, self.k, 1)
+                    gt = future_key_points[:, i, :].unsqueeze(1).expand(-1, self.k, -1)
                     # compute loss for k key points
                     loss_kp_i = self.loss_fct(key_points_logits[:, i, :, :2], gt[..., :2].to(device))  # b, k, 2
                     # if self.config.pred_key_point_yaw:
@@ -550,10 +613,9 @@ class KeyPointMLPDeocder(nn.Module):
                     loss_per_kp_i = self.cls_loss_fct(score_hidden, min_loss_idx)
                     # add loss (regression+classification) for each key point
                     loss_per_kp.append(min_loss.mean() * 0.1**(4-i) + loss_per_kp_i.mean())
-                    selected_logits_at_i = []
-                    for j in range(batch_size):
-                        selected_logits_at_i.append(key_points_logits[j, i, int(min_loss_idx[j]), :].unsqueeze(0))
-                    stacked_selected_logits_at_i = torch.stack(selected_logits_at_i, dim=0)  # [batch_size, 1, 4/2]
+                    # gather the best of k predictions on device, without reading each index back to the host
+                    stacked_selected_logits_at_i = key_points_logits[:, i].gather(
+                        1, min_loss_idx[:, None, None].expand(-1, 1, key_points_logits.shape[-1]))  # [batch_size, 1, 4/2]
                     select_logtis.append(stacked_selected_logits_at_i)
                 loss_per_kp = torch.stack(loss_per_kp)  # [seq_len]
                 # stack the list of selected logits, each has a shape of [batch_size, 1, 4/2]
@@ -612,7 +674,7 @@ class KeyPointMLPDeocder(nn.Module):
 
     def save_features(self,input_embeds,context_length,info_dict,future_key_points,transformer_outputs_hidden_state):
         # print("hidden_state shape: ",transformer_outputs_hidden_state.shape)
-        current_device_idx = int(str(input_embeds.device)[-1])
+        current_device_idx = input_embeds.device.index if input_embeds.device.type == 'cuda' else 0
         context_length = info_dict.get("context_length", None)
         pred_length = info_dict["pred_length"]
         assert context_length is not None, "context length can not be None"
@@ -630,11 +692,70 @@ class KeyPointMLPDeocder(nn.Module):
                 kp_start_index += self.config.proposal_num + pred_length
         # print("kp_end_index: ",kp_end_index)
         save_id = (self.gpu_device_count * self.current_idx + current_device_idx)*key_points_num
+        # copy all key points of this step to pinned host memory at once without blocking the device
+        hidden_state_batch = _FEATURE_SAVER.copy_to_pinned_cpu(transformer_outputs_hidden_state[:, kp_end_index-1:kp_end_index-1+key_points_num, :].detach())
+        key_points_batch = _FEATURE_SAVER.copy_to_pinned_cpu(info_dict['future_key_points'][..., :key_points_num, :].detach())
+        copy_done = None
+        if transformer_outputs_hidden_state.is_cuda:
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+        if self.config.diffusion_feature_shard:
+            _FEATURE_SAVER.submit(self._append_feature_shard, hidden_state_batch, key_points_batch, save_id,
+                                  current_device_idx, self.save_testing_diffusion_feature_dir, copy_done)
+        else:
+            _FEATURE_SAVER.submit(self._save_feature_files, hidden_state_batch, key_points_batch, save_id,
+                                  key_points_num, self.save_testing_diffusion_feature_dir, copy_done)
+        self.current_idx += 1
+
+    @staticmethod
+    def _save_feature_files(hidden_state_batch, key_points_batch, save_id, key_points_num, save_dir, copy_done=None):
+        if copy_done is not None:
+            copy_done.synchronize()
+        # keep one file per key point as the diffusion dataset converter expects
         for key_point_idx in range(key_points_num):
             current_save_id = save_id + key_point_idx
-            torch.save(transformer_outputs_hidden_state[:,kp_end_index-1+key_point_idx:kp_end_index-1+key_point_idx+1,:].detach().cpu(), os.path.join(self.save_testing_diffusion_feature_dir, f'future_key_points_hidden_state_{current_save_id}.pth'), )
-            torch.save(info_dict['future_key_points'][...,key_point_idx:key_point_idx+1,:].detach().cpu(), os.path.join(self.save_testing_diffusion_feature_dir, f'future_key_points_{current_save_id}.pth'), )
-        self.current_idx += 1
+            torch.save(hidden_state_batch[:, key_point_idx:key_point_idx+1, :].clone(), os.path.join(save_dir, f'future_key_points_hidden_state_{current_save_id}.pth'), )
+            torch.save(key_points_batch[..., key_point_idx:key_point_idx+1, :].clone(), os.path.join(save_dir, f'future_key_points_{current_save_id}.pth'), )
+
+    @staticmethod
+    def _append_feature_shard(hidden_state_batch, key_points_batch, save_id, rank, save_dir, copy_done=None):
+        """
+        Append the features of one step to the raw shards of this rank, in rows of one key point of one sample.
+        future_key_points_hidden_state_rank{rank}.bin: float32 rows of (1, n_embd)
+        future_key_points_rank{rank}.bin: float32 rows of (1, 2/4)
+        future_key_points_rank{rank}.index: int64 rows of (save id of the key point, index in batch)
+        future_key_points_rank{rank}.json: row shapes to read the shards back with numpy.memmap
+        """
+        if copy_done is not None:
+            copy_done.synchronize()
+        batch_size, key_points_num, n_embd = hidden_state_batch.shape
+        hidden_state_rows = hidden_state_batch.float().numpy().reshape(-1, 1, n_embd)
+        key_points_rows = key_points_batch.float().numpy().reshape(batch_size * key_points_num, 1, -1)
+        save_ids = save_id + np.arange(key_points_num)
+        index_rows = np.stack(np.broadcast_arrays(save_ids[None, :], np.arange(batch_size)[:, None]), axis=-1).reshape(-1, 2).astype(np.int64)
+        hidden_state_path = os.path.join(save_dir, f'future_key_points_hidden_state_rank{rank}.bin')
+        key_points_path = os.path.join(save_dir, f'future_key_points_rank{rank}.bin')
+        index_path = os.path.join(save_dir, f'future_key_points_rank{rank}.index')
+        meta_path = os.path.join(save_dir, f'future_key_points_rank{rank}.json')
+        # appends to the same shard files of this rank must not interleave
+        with _FEATURE_SAVER.shard_lock:
+            if not os.path.exists(meta_path):
+                with open(meta_path, 'w') as f:
+                    json.dump(dict(dtype='float32',
+                                   hidden_state_shape=list(hidden_state_rows.shape[1:]),
+                                   label_shape=list(key_points_rows.shape[1:])), f)
+            with open(hidden_state_path, 'ab') as f:
+                f.write(hidden_state_rows.tobytes())
+            with open(key_points_path, 'ab') as f:
+                f.write(key_points_rows.tobytes())
+            with open(index_path, 'ab') as f:
+                f.write(index_rows.tobytes())
+
+    def wait_for_saved_features(self):
+        """
+        Block until all features dumped by save_features are written to disk, re-raise errors of the writers.
+        """
+        _FEATURE_SAVER.wait()
 
 
 class KeyPointLinearDecoder(nn.Module):
@@ -39,7 +39,7 @@ class DataAugmentation(nn.Module):
         scale = (torch.arange(context_length, device=device, dtype=target_traj.dtype) + 1) / context_length
         if reverse_scale:
             scale = scale.flip(0)
-        scale = scale.unsqueeze(0).unsqueeze(-1).repeat(target_traj.shape[0], 1, target_traj.shape[-1])
+        scale = scale.unsqueeze(0).unsqueeze(-1).expand(target_traj.shape[0], -1, target_traj.shape[-1])
         if self.training and x_noise_scale > 0:
             x_noise = 1 + scale * random.random() * x_noise_scale * 2 - x_noise_scale
             target_traj[..., 0] *= x_noise[..., 0]
@@ -67,7 +67,7 @@ class DataAugmentation(nn.Module):
         # exponential
         for i in range(10):
             noise_scale.append(0.8 ** i)
-        noise_scale = torch.tensor(noise_scale).unsqueeze(-1).repeat(1, 2).to(device)
+        noise_scale = torch.tensor(noise_scale, device=device).unsqueeze(-1).expand(-1, 2)
         kp_to_add_noise = future_key_points[:, :10, :]
         future_key_points[:, :10, :] += (torch.randn_like(kp_to_add_noise) * noise_scale * 2 - noise_scale) * kp_to_add_noise
         return future_key_points
\ No newline at end of file
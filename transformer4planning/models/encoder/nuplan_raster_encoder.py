@@ -13,7 +13,7 @@ def normalize_angles(angles):
 
 
 class CNNDownSamplingResNet(nn.Module):
-    def __init__(self, d_embed, in_channels, resnet_type='resnet18', pretrain=False):
+    def __init__(self, d_embed, in_channels, resnet_type='resnet18', pretrain=False, skip_classifier=False):
         super(CNNDownSamplingResNet, self).__init__()
         import torchvision.models as models
         if resnet_type == 'resnet18':
@@ -37,14 +37,19 @@ class CNNDownSamplingResNet(nn.Module):
         self.layer1 = nn.Sequential(
             nn.Conv2d(in_channels, 64, kernel_size=(7, 7), stride=(2, 2), padding=(3, 3), bias=False)
         )
-        self.classifier = nn.Sequential(
-            nn.Linear(in_features=cls_feature_dim, out_features=d_embed, bias=True)
-        )
+        if skip_classifier and cls_feature_dim == d_embed:
+            self.classifier = nn.Identity()
+        else:
+            self.classifier = nn.Sequential(
+                nn.Linear(in_features=cls_feature_dim, out_features=d_embed, bias=True)
+            )
 
     def forward(self, x):
+        # NHWC lets cuDNN pick tensor core kernels for the convolutions
+        x = x.contiguous(memory_format=torch.channels_last)
         x = self.layer1(x)
         x = self.cnn(x)
-        output = self.classifier(x.squeeze(-1).squeeze(-1))
+        output = self.classifier(x.flatten(1))
         return output
 
 
@@ -52,7 +57,8 @@ from transformers.activations import ACT2FN
 class STRMultiModalProjector(nn.Module):
     def __init__(self, config):
         super().__init__()
-        projector_hidden_act = 'gelu'
+        # tanh approximation of gelu, cheaper than the erf version on the 8 * 257 camera tokens
+        projector_hidden_act = 'gelu_pytorch_tanh'
         vision_hidden_size = 768
         model_hidden_size = config.get("d_embed")
         self.linear_1 = nn.Linear(vision_hidden_size, model_hidden_size, bias=True)
@@ -81,7 +87,11 @@ class NuplanRasterizeEncoder(TrajectoryEncoder):
             vit_config.intermediate_size = self.config.vit_intermediate_size  # must be multiplier of 12 (number of the head)
             vit_config.num_attention_heads = self.config.n_head
             vit_config.return_dict = True
+            if hasattr(nn.functional, 'scaled_dot_product_attention') and getattr(ViTModel, '_supports_sdpa', False):
+                # fused attention (Flash / memory efficient kernels), same results as the eager softmax attention
+                vit_config._attn_implementation = getattr(self.config, 'attn_implementation', None) or "sdpa"
             self.image_downsample = ViTModel(vit_config)
+            self._encode_rasters = self._encode_vit_rasters
             logger.info(f'Building ViT encoder with key points indices of {self.selected_indices}')
         else:
             try:
@@ -101,8 +111,15 @@ class NuplanRasterizeEncoder(TrajectoryEncoder):
             self.cnn_downsample = CNNDownSamplingResNet(d_embed=cnn_kwargs.get("d_embed", None),
                                                         in_channels=cnn_kwargs.get("in_channels", None),
                                                         resnet_type=cnn_kwargs.get("resnet_type", "resnet18"),
-                                                        pretrain=cnn_kwargs.get("pretrain", False))
+                                                        pretrain=cnn_kwargs.get("pretrain", False),
+                                                        skip_classifier=self.config.skip_resnet_classifier)
+            # fixed raster size, let cuDNN benchmark the convolution algorithms
+            torch.backends.cudnn.benchmark = True
+            self.cnn_downsample = self.cnn_downsample.to(memory_format=torch.channels_last)
+            self._encode_rasters = self._encode_cnn_rasters
             logger.info(f'Building ResNet encoder with key points indices of {self.selected_indices}')
+        # CUDA graphs of the raster encoder for inference, keyed by input shape
+        self._graph_cache = {}
 
         # separate key point encoder is hard to train with larger models due to sparse signals
         input_dim = 7 if self.config.use_speed else 4
@@ -110,6 +127,9 @@ class NuplanRasterizeEncoder(TrajectoryEncoder):
         self.action_m_embed_traj = nn.Sequential(nn.Linear(4, action_kwargs.get("d_embed")), nn.Tanh())
 
         self.traj_tokenizer = None
+        # static proposals of the tokenizer on device, and their embeddings cached at inference
+        self._candidate_proposal = None
+        self._candi_embeds = None
 
         # For key points, only use x, and y
         # currently forcing key point to be 2 dimension, with no speed and no yaw
@@ -124,6 +144,8 @@ class NuplanRasterizeEncoder(TrajectoryEncoder):
 
         self.image_processor = None
         self.camera_image_encoder = None
+        # side stream to copy camera images while the raster encoder runs, created on first use
+        self._camera_stream = None
         self.image_feature_connector = None
         if config.camera_image_encoder == 'dinov2':
             # WIP
@@ -141,28 +163,174 @@ class NuplanRasterizeEncoder(TrajectoryEncoder):
             # self.camera_image_m_embed = nn.Sequential(nn.Linear(768, action_kwargs.get("d_embed")), nn.Tanh())
             # self.camera_image_m_embed = nn.Sequential(nn.Linear(768, action_kwargs.get("d_embed"), bias=False))
             self.camera_image_m_embed = STRMultiModalProjector(action_kwargs)
+            # preprocess camera images on device following the settings of the image processor
+            self.camera_resize_shortest_edge = self.image_processor.size["shortest_edge"]
+            self.camera_crop_size = (self.image_processor.crop_size["height"], self.image_processor.crop_size["width"])
+            self.register_buffer('camera_image_mean', torch.tensor(self.image_processor.image_mean).view(1, 3, 1, 1), persistent=False)
+            self.register_buffer('camera_image_std', torch.tensor(self.image_processor.image_std).view(1, 3, 1, 1), persistent=False)
             for param in self.camera_image_encoder.parameters():
                 param.requires_grad = False
+            # the camera encoder is frozen, keep it in bf16 and eval mode
+            self.camera_image_encoder.to(dtype=torch.bfloat16).eval()
+
+    def train(self, mode=True):
+        # captured graphs hold static buffers and won't follow module changes, drop them on mode switch
+        self._graph_cache = {}
+        self._candi_embeds = None
+        super().train(mode)
+        if self.camera_image_encoder is not None:
+            self.camera_image_encoder.eval()
+        return self
+
+    def _raster_downsample_eager(self, raster_seq):
+        if self._encode_rasters == self._encode_vit_rasters:
+            return self.image_downsample(pixel_values=raster_seq).last_hidden_state
+        return self.cnn_downsample(raster_seq)
+
+    def raster_downsample(self, raster_seq):
+        """
+        Encode rasters of shape (N, c, h, w) with the ViT / ResNet downsampler.
+        ViT returns the last hidden state including the cls token, ResNet returns (N, embed_dim//2).
+        At inference on GPU, the encoder is captured into a CUDA graph per input shape and replayed afterwards.
+        """
+        if self.training or torch.is_grad_enabled() or not raster_seq.is_cuda or self.config.disable_vit_cudagraph:
+            return self._raster_downsample_eager(raster_seq)
+        # static buffers allocated under inference mode can not be written in place outside of it, a graph captured
+        # under autocast runs other kernels and returns another dtype than one captured without
+        autocast_enabled = torch.is_autocast_enabled()
+        autocast_dtype = torch.get_autocast_dtype('cuda') if hasattr(torch, 'get_autocast_dtype') else torch.get_autocast_gpu_dtype()
+        key = (tuple(raster_seq.shape), raster_seq.dtype, raster_seq.device, torch.is_inference_mode_enabled(),
+               autocast_enabled, autocast_dtype if autocast_enabled else None)
+        if key not in self._graph_cache:
+            static_in = raster_seq.clone()
+            # the weight casts of the autocast cache live outside of the graph pool and are freed when the outer
+            # autocast exits, warm up and capture without the cache so the graph owns the casted weights
+            no_cache_autocast = torch.autocast(device_type='cuda', dtype=autocast_dtype, enabled=autocast_enabled,
+                                               cache_enabled=False)
+            # warm up on a side stream before capturing
+            side_stream = torch.cuda.Stream(device=raster_seq.device)
+            side_stream.wait_stream(torch.cuda.current_stream(raster_seq.device))
+            with torch.cuda.stream(side_stream), no_cache_autocast:
+                for _ in range(3):
+                    self._raster_downsample_eager(static_in)
+            torch.cuda.current_stream(raster_seq.device).wait_stream(side_stream)
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph), no_cache_autocast:
+                static_out = self._raster_downsample_eager(static_in)
+            self._graph_cache[key] = (graph, static_in, static_out)
+        graph, static_in, static_out = self._graph_cache[key]
+        static_in.copy_(raster_seq)
+        graph.replay()
+        return static_out.clone()
+
+    def _encode_vit_rasters(self, high_res_seq, low_res_seq, action_embeds):
+        """
+        Encode raster sequences with ViT and interleave with action embeddings as O(196 patches)A for each frame.
+        `high_res_seq`, `low_res_seq`: torch.Tensor, shape (batch_size, seq, c, h, w), already in the dtype of action_embeds
+        `action_embeds`: torch.Tensor, shape (batch_size, seq, n_embed)
+        return `input_embeds`: torch.Tensor, shape (batch_size, seq * (1 + sequence_length), n_embed)
+               `sequence_length`: int, the number of patches for each frame
+        """
+        batch_size, action_seq_length, c, h, w = high_res_seq.shape
+        # encode both resolutions in one batched call: 2 * batch_size * context_length, c, h, w
+        raster_seq = torch.cat([high_res_seq, low_res_seq], dim=0).reshape(2 * batch_size * action_seq_length, c, h, w)
+        high_res_embed, low_res_embed = self.raster_downsample(raster_seq)[:, 1:, :].chunk(2, dim=0)
+        # batch_size * context_length, 196 (14*14), embed_dim//2
+        _, sequence_length, half_embed = high_res_embed.shape
+        n_embed = action_embeds.shape[-1]
+        # interleave as O(196 tokens) A for each frame: batch_size, action_seq_length, 1 + sequence_length, embed_dim
+        # high and low resolution embeddings are written into the two halves of the state embedding directly
+        input_embeds = torch.empty(
+            (batch_size, action_seq_length, 1 + sequence_length, n_embed),
+            dtype=action_embeds.dtype,
+            device=action_embeds.device
+        )
+        input_embeds[:, :, :sequence_length, :half_embed] = high_res_embed.reshape(batch_size, action_seq_length, sequence_length, half_embed)
+        input_embeds[:, :, :sequence_length, half_embed:] = low_res_embed.reshape(batch_size, action_seq_length, sequence_length, half_embed)
+        input_embeds[:, :, sequence_length, :] = action_embeds
+        input_embeds = input_embeds.reshape(batch_size, action_seq_length * (1 + sequence_length), n_embed)
+        return input_embeds, sequence_length
 
-    def get_proposal_cluster_embedding(self, info_dict, device, input_embeds, trajectory_label=None):
+    def _encode_cnn_rasters(self, high_res_seq, low_res_seq, action_embeds):
+        """
+        Encode raster sequences with ResNet and interleave with action embeddings as OA for each frame.
+        Same inputs and outputs as `_encode_vit_rasters`, with one state embedding for each frame.
+        """
+        batch_size, action_seq_length, c, h, w = high_res_seq.shape
+        raster_seq = torch.cat([high_res_seq, low_res_seq], dim=0).reshape(2 * batch_size * action_seq_length, c, h, w)
+        high_res_embed, low_res_embed = self.raster_downsample(raster_seq).chunk(2, dim=0)
+        half_embed = high_res_embed.shape[-1]
+        n_embed = action_embeds.shape[-1]
+        # batch_size, action_seq_length, 2 (OA), embed_dim
+        input_embeds = torch.empty(
+            (batch_size, action_seq_length, 2, n_embed),
+            dtype=action_embeds.dtype,
+            device=action_embeds.device
+        )
+        input_embeds[:, :, 0, :half_embed] = high_res_embed.reshape(batch_size, action_seq_length, half_embed)  # index: 0, 2, 4, .., 18
+        input_embeds[:, :, 0, half_embed:] = low_res_embed.reshape(batch_size, action_seq_length, half_embed)
+        input_embeds[:, :, 1, :] = action_embeds  # index: 1, 3, 5, .., 19
+        input_embeds = input_embeds.reshape(batch_size, action_seq_length * 2, n_embed)
+        return input_embeds, 1
+
+    def preprocess_camera_images(self, camera_images):
+        """
+        Tensor version of the DINOv2 image processor: resize the shortest edge, center crop, rescale and normalize.
+        `camera_images`: torch.Tensor, shape (n, h, w, 3), RGB values in [0, 255]
+        return `pixel_values`: torch.Tensor, shape (n, 3, crop_h, crop_w)
+        """
+        pixel_values = camera_images.permute(0, 3, 1, 2).float()
+        h, w = pixel_values.shape[-2:]
+        scale = self.camera_resize_shortest_edge / min(h, w)
+        # the processor resizes uint8 images with PIL bicubic, which antialiases when downscaling, and its output is
+        # rounded and clipped back to [0, 255]
+        pixel_values = nn.functional.interpolate(pixel_values, size=(int(h * scale), int(w * scale)),
+                                                 mode='bicubic', align_corners=False, antialias=True)
+        pixel_values = pixel_values.round_().clamp_(0, 255) / 255.0
+        crop_h, crop_w = self.camera_crop_size
+        top = (pixel_values.shape[-2] - crop_h) // 2
+        left = (pixel_values.shape[-1] - crop_w) // 2
+        pixel_values = pixel_values[:, :, top:top + crop_h, left:left + crop_w]
+        return (pixel_values - self.camera_image_mean) / self.camera_image_std
+
+    def get_candidate_proposal(self, device):
+        """
+        Static proposal trajectories from the tokenizer, moved to device once.
+        return `candidate_proposal`: torch.Tensor, shape (n_candi, traj_proposal_points_num, 3)
+        """
+        if self._candidate_proposal is None or self._candidate_proposal.device != device:
+            self._candidate_proposal = self.traj_tokenizer.trajs[:, :self.config.traj_proposal_points_num, :].to(device)
+        return self._candidate_proposal
+
+    def get_proposal_cluster_embedding(self, info_dict, device, batch_size, trajectory_label=None):
+        """
+        Embed the proposal candidates and the ground truth cluster trajectory.
+        return `candi_embeds`: torch.Tensor, shape (batch_size, n_candi, n_embed)
+               `traj_cls_embedding`: torch.Tensor, shape (batch_size, seq, n_embed)
+        """
         # pass score when generate function is called
-        candidate_proposal = self.traj_tokenizer.trajs.to(device)[:, :self.config.traj_proposal_points_num, :]
+        candidate_proposal = self.get_candidate_proposal(device)
         info_dict['candi_proposal_num'] = candidate_proposal.shape[0]
         assert int(info_dict['candi_proposal_num']) == int(self.config.use_proposal), f'proposal {candidate_proposal.shape[0]}, but got {self.config.use_proposal}'
         # n_candi,80, 3 -> n_candi,240 -> n_candi,256
-        candidate_proposal_ = candidate_proposal.reshape(candidate_proposal.shape[0], -1)
-        candi_embeds = self.proposal_m_embed(candidate_proposal_)
+        # proposal_m_embed is trainable, only reuse the embeddings at inference
+        if self._candi_embeds is not None and self._candi_embeds.device == device:
+            candi_embeds = self._candi_embeds
+        else:
+            candidate_proposal_ = candidate_proposal.reshape(candidate_proposal.shape[0], -1)
+            candi_embeds = self.proposal_m_embed(candidate_proposal_)
+            if not self.training and not torch.is_grad_enabled():
+                self._candi_embeds = candi_embeds
         # n_candi,256 -> bs,n_candi,256
-        bs = input_embeds.shape[0]
-        candi_embeds = candi_embeds.unsqueeze(0).repeat(bs, 1, 1)
-        input_embeds = torch.cat([input_embeds, candi_embeds], dim=1)  # bs,context_length+n_candi,256
+        candi_embeds = candi_embeds.unsqueeze(0).expand(batch_size, -1, -1)
         # use gt score for training
-        traj_gt = trajectory_label[:, :, [0, 1]].unsqueeze(1)  # bs,1,seq,2
-        expanded_candidate_trajectory = candidate_proposal[:, :, [0, 1]].unsqueeze(0).repeat(bs, 1, 1, 1)  # bs,n_candi,seq,2
+        traj_gt = trajectory_label[:, :, :2].unsqueeze(1)  # bs,1,seq,2
+        # broadcast in the subtraction instead of materializing the batch copies
+        expanded_candidate_trajectory = candidate_proposal[:, :, :2].unsqueeze(0)  # 1,n_candi,seq,2
         # 计算每条轨迹与目标轨迹对应点之间的差值
         diff = expanded_candidate_trajectory - traj_gt  # bs, n_candi, seq, 2
         # 计算欧式距离
-        distances = torch.sqrt(torch.sum(diff ** 2, dim=-1))  # 对最后一个维度求和  bs, n_candi, seq
+        distances = torch.linalg.vector_norm(diff, dim=-1)  # 对最后一个维度求和  bs, n_candi, seq
         distances = torch.mean(distances, dim=-1)  # ADE: bs, n_candi
         info_dict['future_traj_diff'] = distances.to(device)
         # import matplotlib.pyplot as plt
@@ -186,12 +354,14 @@ class NuplanRasterizeEncoder(TrajectoryEncoder):
         #                           gt_prob_embed.unsqueeze(1)], dim=1)  # bs,context_length+n_candi+1,256
         gt_index = torch.argmin(gt_l2_distance, dim=-1)
         traj_cls_gt = self.traj_tokenizer.decode(gt_index)
-        zeros_tensor = torch.zeros([traj_cls_gt.shape[0], traj_cls_gt.shape[1], 1]).to(traj_cls_gt.device)
-        traj_cls_gt = torch.cat((traj_cls_gt[:, :, :2], zeros_tensor, traj_cls_gt[:, :, 2:]), dim=-1)
+        # padding z on device, from x, y, yaw to x, y, z, yaw
+        traj_cls_gt_padded = traj_cls_gt.new_zeros((traj_cls_gt.shape[0], traj_cls_gt.shape[1], 4))
+        traj_cls_gt_padded[:, :, :2] = traj_cls_gt[:, :, :2]
+        traj_cls_gt_padded[:, :, 3:] = traj_cls_gt[:, :, 2:]
+        traj_cls_gt = traj_cls_gt_padded
         traj_cls_embedding = self.action_m_embed_traj(traj_cls_gt)
-        input_embeds = torch.cat([input_embeds, traj_cls_embedding], dim=1)
 
-        return input_embeds, info_dict, candi_embeds
+        return candi_embeds, traj_cls_embedding, info_dict
 
     def forward(self, **kwargs):
         """
@@ -224,63 +394,52 @@ class NuplanRasterizeEncoder(TrajectoryEncoder):
         _, pred_length = trajectory_label.shape[:2]
         action_seq_length = context_actions.shape[1] if context_actions is not None else -1  # -1 in case of pdm encoder
 
+        camera_images = kwargs.get("camera_images", None)
+        camera_copy_stream = None
+        if self.camera_image_encoder is not None and camera_images is not None and device.type == 'cuda' and not camera_images.is_cuda:
+            # overlap the camera images H2D copy (pinned by the dataloader) with the raster encoder
+            if self._camera_stream is None:
+                self._camera_stream = torch.cuda.Stream(device=device)
+            camera_copy_stream = self._camera_stream
+            camera_copy_stream.wait_stream(torch.cuda.current_stream(device))
+            with torch.cuda.stream(camera_copy_stream):
+                camera_images = camera_images.to(device, non_blocking=True)
+
         # add noise to context actions
         context_actions = self.augmentation.trajectory_linear_augmentation(context_actions, self.config.x_random_walk, self.config.y_random_walk)
         # raster observation encoding & context action ecoding
         action_embeds = self.action_m_embed(context_actions)
 
-        high_res_seq = cat_raster_seq(high_res_raster.permute(0, 3, 2, 1).to(device), action_seq_length, self.config.with_traffic_light)
-        low_res_seq = cat_raster_seq(low_res_raster.permute(0, 3, 2, 1).to(device), action_seq_length, self.config.with_traffic_light)
+        # move and cast in one copy, cat_raster_seq writes the (b, seq, c, h, w) layout once
+        high_res_raster = high_res_raster.to(device=device, dtype=action_embeds.dtype, non_blocking=True)
+        low_res_raster = low_res_raster.to(device=device, dtype=action_embeds.dtype, non_blocking=True)
+        high_res_seq = cat_raster_seq(high_res_raster.permute(0, 3, 2, 1), action_seq_length, self.config.with_traffic_light)
+        low_res_seq = cat_raster_seq(low_res_raster.permute(0, 3, 2, 1), action_seq_length, self.config.with_traffic_light)
         # casted channel number: 33 - 1 goal, 20 raod types, 3 traffic light, 9 agent types for each time frame
         # context_length: 8, 40 frames / 5
         batch_size, action_seq_length, c, h, w = high_res_seq.shape
         assert c == self.config.raster_channels, "raster channel number should be {}, but got {}".format(self.config.raster_channels, c)
 
-        if self.config.raster_encoder_type == 'vit':
-            high_res_embed = self.image_downsample(pixel_values=high_res_seq.to(action_embeds.dtype).reshape(batch_size * action_seq_length, c, h, w)).last_hidden_state[:, 1:, :]
-            low_res_embed = self.image_downsample(pixel_values=low_res_seq.to(action_embeds.dtype).reshape(batch_size * action_seq_length, c, h, w)).last_hidden_state[:, 1:, :]
-            # batch_size * context_length, 196 (14*14), embed_dim//2
-            _, sequence_length, half_embed = high_res_embed.shape
-            high_res_embed = high_res_embed.reshape(batch_size, action_seq_length, sequence_length, half_embed)
-            low_res_embed = low_res_embed.reshape(batch_size, action_seq_length, sequence_length, half_embed)
-
-            state_embeds = torch.cat((high_res_embed, low_res_embed), dim=-1).to(action_embeds.dtype)  # batch_size, action_seq_length, sequence_length, embed_dim
-            n_embed = action_embeds.shape[-1]
-            context_length = action_seq_length + action_seq_length * sequence_length
-            input_embeds = torch.zeros(
-                (batch_size, context_length, n_embed),
-                dtype=action_embeds.dtype,
-                device=device
-            )
-            for j in range(action_seq_length):
-                input_embeds[:, j * (1 + sequence_length): j * (1 + sequence_length) + sequence_length, :] = state_embeds[:, j, :, :]
-            input_embeds[:, sequence_length::1 + sequence_length, :] = action_embeds
-        else:
-            high_res_embed = self.cnn_downsample(high_res_seq.to(action_embeds.dtype).reshape(batch_size * action_seq_length, c, h, w))
-            low_res_embed = self.cnn_downsample(low_res_seq.to(action_embeds.dtype).reshape(batch_size * action_seq_length, c, h, w))
-            high_res_embed = high_res_embed.reshape(batch_size, action_seq_length, -1)
-            low_res_embed = low_res_embed.reshape(batch_size, action_seq_length, -1)
-
-            state_embeds = torch.cat((high_res_embed, low_res_embed), dim=-1).to(action_embeds.dtype)
-            n_embed = action_embeds.shape[-1]
-            context_length = action_seq_length * 2
-            input_embeds = torch.zeros(
-                (batch_size, context_length, n_embed),
-                dtype=action_embeds.dtype,
-                device=device
-            )
-            input_embeds[:, ::2, :] = state_embeds  # index: 0, 2, 4, .., 18
-            input_embeds[:, 1::2, :] = action_embeds  # index: 1, 3, 5, .., 19
+        input_embeds, sequence_length = self._encode_rasters(high_res_seq, low_res_seq, action_embeds)
+        n_embed = action_embeds.shape[-1]
+        context_length = action_seq_length * (1 + sequence_length)
+        # collect all segments and write them into the final input_embeds once
+        embeds_to_concat = [input_embeds]
 
         if self.camera_image_encoder is not None:
-            camera_images = kwargs.get("camera_images", None)
             assert camera_images is not None, "camera_image should not be None"
-            if self.image_processor is not None:
-                _, _, image_width, image_height, image_channels = camera_images.shape
-                camera_images = camera_images.reshape(batch_size*8, image_width, image_height, image_channels)
-                camera_inputs = self.image_processor(camera_images, return_tensors="pt")
-            camera_inputs = camera_inputs.to(device)
-            camera_image_feature = self.camera_image_encoder(**camera_inputs).last_hidden_state  # batch_size * 8, 257, 768
+            if camera_copy_stream is not None:
+                torch.cuda.current_stream(device).wait_stream(camera_copy_stream)
+                camera_images.record_stream(torch.cuda.current_stream(device))
+            _, _, image_height, image_width, image_channels = camera_images.shape
+            camera_images = camera_images.reshape(batch_size*8, image_height, image_width, image_channels).to(device)
+            pixel_values = self.preprocess_camera_images(camera_images)
+            # frozen encoder, skip autograd tracing
+            with torch.no_grad():
+                camera_image_feature = self.camera_image_encoder(
+                    pixel_values=pixel_values.to(self.camera_image_encoder.dtype)
+                ).last_hidden_state  # batch_size * 8, 257, 768
+            camera_image_feature = camera_image_feature.to(action_embeds.dtype)
 
             # compress all patches into one hidden state
             # camera_image_feature = camera_image_feature.reshape(batch_size, 8, 257 * 768)
@@ -291,7 +450,7 @@ class NuplanRasterizeEncoder(TrajectoryEncoder):
             # spead all patches into hidden states
             camera_image_feature = camera_image_feature.reshape(batch_size, 8 * 257, 768)
             camera_image_embed = self.camera_image_m_embed(camera_image_feature)  # batch_size, 8 * 257, n_embed
-            input_embeds = torch.cat([input_embeds, camera_image_embed], dim=1)
+            embeds_to_concat.append(camera_image_embed)
             context_length += 8 * 257
 
         info_dict = {
@@ -305,8 +464,9 @@ class NuplanRasterizeEncoder(TrajectoryEncoder):
         if self.use_proposal:
             assert self.config.traj_tokenizer == 'cluster_traj', 'only support cluster_traj for now'
             # inpute_embedc -> bs,context_length+n_candi+1,256  (788->1301 (512+1))
-            input_embeds, info_dict, candi_embeds = self.get_proposal_cluster_embedding(info_dict, device, input_embeds,
-                                                                                        trajectory_label=trajectory_label)
+            candi_embeds, traj_cls_embedding, info_dict = self.get_proposal_cluster_embedding(info_dict, device, batch_size,
+                                                                                              trajectory_label=trajectory_label)
+            embeds_to_concat += [candi_embeds, traj_cls_embedding]
 
         # add keypoints encoded embedding
         if self.use_key_points == 'no':
@@ -323,17 +483,22 @@ class NuplanRasterizeEncoder(TrajectoryEncoder):
                 if self.config.kp_decoder_type == "mlp":
                     # 1380 -> 1380+5=1385
                     future_key_embeds = self.kps_m_embed(future_key_points_aug)
-                    input_embeds = torch.cat([input_embeds, future_key_embeds], dim=1)
+                    embeds_to_concat.append(future_key_embeds)
             else:
                 assert False, 'deprecated for clarity, use separate_kp_encoder instead'
             info_dict['future_key_points'] = future_key_points
 
         # padding the input_embeds with pred_length zeros
         # 1385 -> 1385+80=1465
-        input_embeds = torch.cat([input_embeds,
-                                  torch.zeros((batch_size, pred_length, n_embed),
-                                              device=device,
-                                              dtype=action_embeds.dtype)], dim=1)
+        embeds_length = sum(each_embeds.shape[1] for each_embeds in embeds_to_concat)
+        input_embeds = torch.empty((batch_size, embeds_length + pred_length, n_embed),
+                                   device=device,
+                                   dtype=action_embeds.dtype)
+        start_index = 0
+        for each_embeds in embeds_to_concat:
+            input_embeds[:, start_index:start_index + each_embeds.shape[1], :] = each_embeds
+            start_index += each_embeds.shape[1]
+        input_embeds[:, embeds_length:, :] = 0
         info_dict['selected_indices'] = self.selected_indices
         return input_embeds, info_dict
 
@@ -357,33 +522,14 @@ class NuplanRasterizeAutoRegressiveEncoder(NuplanRasterizeEncoder):
         # assert not self.config.use_speed, "AutoRegressiveEncoder does not support speed, generating speed with autoregression is not reasonable"
         action_embeds = self.action_m_embed(trajectory)
 
-        high_res_seq = high_res_raster.permute(0, 1, 4, 2, 3).to(device)
-        low_res_seq = low_res_raster.permute(0, 1, 4, 2, 3).to(device)
+        # transfer the contiguous rasters first, the permuted view is materialized only once when batching both resolutions
+        high_res_seq = high_res_raster.to(device=device, dtype=action_embeds.dtype, non_blocking=True).permute(0, 1, 4, 2, 3)
+        low_res_seq = low_res_raster.to(device=device, dtype=action_embeds.dtype, non_blocking=True).permute(0, 1, 4, 2, 3)
         batch_size, raster_seq_length, c, h, w = high_res_seq.shape
         assert c == self.config.raster_channels, "raster channel number should be {}, but got {}".format(self.config.raster_channels, c)
 
-        if self.config.raster_encoder_type == 'vit':
-            high_res_embed = self.image_downsample(pixel_values=high_res_seq.to(action_embeds.dtype).reshape(batch_size * raster_seq_length, c, h, w)).last_hidden_state[:, 1:, :]
-            low_res_embed = self.image_downsample(pixel_values=low_res_seq.to(action_embeds.dtype).reshape(batch_size * raster_seq_length, c, h, w)).last_hidden_state[:, 1:, :]
-            # batch_size * context_length, 196 (14*14), embed_dim//2
-            _, sequence_length, half_embed = high_res_embed.shape
-            high_res_embed = high_res_embed.reshape(batch_size, raster_seq_length, sequence_length, half_embed)
-            low_res_embed = low_res_embed.reshape(batch_size, raster_seq_length, sequence_length, half_embed)
-
-            state_embeds = torch.cat((high_res_embed, low_res_embed), dim=-1).to(action_embeds.dtype)
-            n_embed = action_embeds.shape[-1]
-            embed_sequence_length = raster_seq_length + raster_seq_length * sequence_length  # each O occupy 196 states
-            input_embeds = torch.zeros(
-                (batch_size, embed_sequence_length, n_embed),
-                dtype=action_embeds.dtype,
-                device=device
-            )
-            for j in range(raster_seq_length):
-                # apply raster embedding to the input
-                input_embeds[:, j * (1 + sequence_length): j * (1 + sequence_length) + sequence_length, :] = state_embeds[:, j, :, :]
-            input_embeds[:, sequence_length::1 + sequence_length, :] = action_embeds
-        else:
-            assert False, "AutoRegressiveEncoder does not support ResNet encoder"
+        assert self._encode_rasters == self._encode_vit_rasters, "AutoRegressiveEncoder does not support ResNet encoder"
+        input_embeds, sequence_length = self._encode_rasters(high_res_seq, low_res_seq, action_embeds)  # each O occupy 196 states
 
         assert self.camera_image_encoder is None, "AutoRegressiveEncoder does not support camera image encoder"
         assert not self.use_proposal, "AutoRegressiveEncoder does not support proposal"
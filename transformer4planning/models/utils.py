@@ -15,6 +15,7 @@ def cat_raster_seq(raster:Optional[torch.LongTensor], framenum=9, traffic=True):
     """
     input raster can be either high resolution raster or low resolution raster
     expected input size: [bacthsize, channel, h, w], and channel is consisted of goal(1d)+roadtype(20d)+agenttype*time(8*9d)
+    output size: [batchsize, framenum, channel_per_frame, h, w], keeping the dtype and device of the input
     """
     b, c, h, w = raster.shape
     agent_type = 8
@@ -23,20 +24,14 @@ def cat_raster_seq(raster:Optional[torch.LongTensor], framenum=9, traffic=True):
     # updated to dynamic route types
     route_type = c - agent_type * framenum - road_type - traffic_light_type
 
-    goal_raster = raster[:, :route_type, :, :].reshape(b, route_type, h, w)  # updated as route raster
-    road_ratser = raster[:, route_type : route_type+road_type, :, :]
-    traffic_raster = raster[:, route_type + road_type : route_type + road_type + traffic_light_type, :, :]
-    if traffic:
-        result = torch.zeros((b, framenum, agent_type + road_type + traffic_light_type + route_type, h, w), device=raster.device)
-    else:
-        result = torch.zeros((b, framenum, agent_type + road_type + route_type, h, w), device=raster.device)
-    for i in range(framenum):
-        agent_raster = raster[:, route_type + road_type + traffic_light_type + i::framenum, :, :]
-        if traffic:
-            raster_i = torch.cat([goal_raster, road_ratser, traffic_raster, agent_raster], dim = 1)  # expected format (b, 1+20+8, h, w)
-        else:
-            raster_i = torch.cat([goal_raster, road_ratser, agent_raster], dim = 1)
-        result[:, i, :, :, :] = raster_i
+    # goal(route), road and traffic light channels are shared by all frames
+    static_type = route_type + road_type + traffic_light_type if traffic else route_type + road_type
+    agent_start = route_type + road_type + traffic_light_type
+    result = torch.empty((b, framenum, static_type + agent_type, h, w), dtype=raster.dtype, device=raster.device)
+    result[:, :, :static_type, :, :] = raster[:, :static_type, :, :].unsqueeze(1)
+    # agent channels are ordered as agent_type * framenum: the channel of agent k at frame i is k * framenum + i
+    agent_raster = raster[:, agent_start:, :, :].reshape(b, agent_type, framenum, h, w)
+    result[:, :, static_type:, :, :] = agent_raster.transpose(1, 2)  # expected format (b, framenum, 1+20+8, h, w)
 
     return result
 
@@ -1,7 +1,9 @@
+import functools
+import weakref
 import numpy as np
 from typing import Dict, List, Tuple
 from nuplan.common.actor_state.ego_state import EgoState
-from nuplan.common.actor_state.state_representation import StateSE2
+from nuplan.common.actor_state.state_representation import Point2D, StateSE2
 from nuplan.common.maps.abstract_map import AbstractMap
 from nuplan.common.maps.abstract_map_objects import RoadBlockGraphEdgeMapObject
 from nuplan.common.maps.maps_datatypes import SemanticMapLayer
@@ -173,6 +175,36 @@ def remove_route_loops(
 
     return route_roadblocks, route_roadblock_ids
 
+# map apis by id, to look them up again in the cached nearest map object queries
+_map_api_registry = weakref.WeakValueDictionary()
+
+
+@functools.lru_cache(maxsize=8192)
+def _get_nearest_map_object_id(map_name: str, map_api_id: int, layer_value: int, x_q: float, y_q: float) -> str:
+    """
+    Cached map_api.get_distance_to_nearest_map_object on a point rounded to 0.1m.
+    The map name is part of the key so that a reused id of a collected map api can not serve another map.
+    """
+    map_api = _map_api_registry[map_api_id]
+    map_object_id, _ = map_api.get_distance_to_nearest_map_object(
+        point=Point2D(x_q, y_q), layer=SemanticMapLayer(layer_value)
+    )
+    return map_object_id
+
+
+def get_nearest_map_object_id(map_api: AbstractMap, layer: SemanticMapLayer, x: float, y: float) -> str:
+    """
+    Id of the nearest map object of the layer, consecutive queries around the same position are served from memory
+    :param map_api: map object
+    :param layer: semantic layer to query
+    :param x: x of the query point in global coordination
+    :param y: y of the query point in global coordination
+    :return: id of the nearest map object
+    """
+    _map_api_registry[id(map_api)] = map_api
+    return _get_nearest_map_object_id(map_api.map_name, id(map_api), layer.value, round(float(x), 1), round(float(y), 1))
+
+
 def get_current_roadblock_candidates(
     ego_position,
     map_api: AbstractMap,
@@ -203,9 +235,7 @@ def get_current_roadblock_candidates(
 
     if not roadblock_candidates:
         for layer in layers:
-            roadblock_id_, distance = map_api.get_distance_to_nearest_map_object(
-                point=ego_pose.point, layer=layer
-            )
+            roadblock_id_ = get_nearest_map_object_id(map_api, layer, ego_pose.x, ego_pose.y)
             roadblock = map_api.get_map_object(roadblock_id_, layer)
 
             if roadblock:
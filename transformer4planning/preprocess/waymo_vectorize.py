@@ -5,6 +5,11 @@ import pickle
 from functools import partial
 from transformer4planning.utils.waymo_utils import merge_batch_by_padding_2nd_dim
 
+# keys collated by numpy concatenation and by padding the 2nd dim, the remaining keys are concatenated as tensors
+CONCAT_KEYS = frozenset(["scenario_id", "obj_types", "obj_ids", "center_objects_type", "center_objects_id"])
+PADDING_KEYS = frozenset(["obj_trajs", "obj_trajs_mask", "map_polylines", "map_polylines_mask", "map_polylines_center",
+                          "obj_trajs_pos", "obj_trajs_last_pos", "obj_trajs_future_state", "obj_trajs_future_mask"])
+
 def waymo_collate_func(batch, dic_path=None):
     map_func = partial(waymo_preprocess, data_path=dic_path)
 
@@ -26,10 +31,9 @@ def waymo_collate_func(batch, dic_path=None):
                 list_of_dvalues.append(d[key])
             else:
                 print("Error: None value", key, d[key])   # scenario_type might be none for older dataset
-        if key in ["scenario_id", "obj_types", "obj_ids", "center_objects_type", "center_objects_id"]:
+        if key in CONCAT_KEYS:
             result[key] = np.concatenate(list_of_dvalues, axis=0).reshape(-1)
-        elif key in ["obj_trajs", "obj_trajs_mask", "map_polylines", "map_polylines_mask", "map_polylines_center",
-                "obj_trajs_pos", "obj_trajs_last_pos", "obj_trajs_future_state", "obj_trajs_future_mask"]:
+        elif key in PADDING_KEYS:
             list_of_dvalues = [torch.from_numpy(x) for x in list_of_dvalues]
             result[key] = merge_batch_by_padding_2nd_dim(list_of_dvalues)
         else:
@@ -176,9 +176,9 @@ def compute_metrics(prediction: EvalPrediction):
             fde_y_error_key_points_gen = prediction_key_points_by_generation[:, 0, 1] - label_key_points[:, 0, 1]
         else:
             assert False, selected_indices
-        ade_key_points_gen = np.sqrt(ade_x_error_key_points_gen ** 2 + ade_y_error_key_points_gen ** 2).mean()
+        ade_key_points_gen = np.hypot(ade_x_error_key_points_gen, ade_y_error_key_points_gen).mean()
         eval_result['ade_keypoints_gen'] = ade_key_points_gen
-        fde_key_points_gen = np.sqrt(fde_x_error_key_points_gen ** 2 + fde_y_error_key_points_gen ** 2).mean()
+        fde_key_points_gen = np.hypot(fde_x_error_key_points_gen, fde_y_error_key_points_gen).mean()
         eval_result['fde_keypoints_gen'] = fde_key_points_gen
 
     ade_x_error_gen = prediction_trajectory_by_generation[:, :, 0] - labels[:, :, 0]
@@ -193,11 +193,11 @@ def compute_metrics(prediction: EvalPrediction):
         index_rescale = 1
 
     # ADE metrics computation
-    ade_gen = np.sqrt(copy.deepcopy(ade_x_error_gen) ** 2 + copy.deepcopy(ade_y_error_gen) ** 2)
-    ade1_gen = np.mean(copy.deepcopy(ade_gen[:, :(10//index_rescale)]), axis=1)
-    ade3_gen = np.mean(copy.deepcopy(ade_gen[:, :(30//index_rescale)]), axis=1)
-    ade5_gen = np.mean(copy.deepcopy(ade_gen[:, :(50//index_rescale)]), axis=1)
-    ade8_gen = np.mean(copy.deepcopy(ade_gen[:, :(80//index_rescale)]), axis=1)
+    ade_gen = np.hypot(ade_x_error_gen, ade_y_error_gen)
+    ade1_gen = np.mean(ade_gen[:, :(10//index_rescale)], axis=1)
+    ade3_gen = np.mean(ade_gen[:, :(30//index_rescale)], axis=1)
+    ade5_gen = np.mean(ade_gen[:, :(50//index_rescale)], axis=1)
+    ade8_gen = np.mean(ade_gen[:, :(80//index_rescale)], axis=1)
     avg_ade_gen = (ade3_gen + ade5_gen + ade8_gen)/3
     ade_score = np.ones_like(avg_ade_gen) - avg_ade_gen/ADE_THRESHHOLD
     ade_score = np.where(ade_score < 0, np.zeros_like(ade_score), ade_score)
@@ -217,7 +217,7 @@ def compute_metrics(prediction: EvalPrediction):
     fde1_gen = copy.deepcopy(ade_gen[:, 9 // index_rescale])
     fde3_gen = copy.deepcopy(ade_gen[:, 29//index_rescale])
     fde5_gen = copy.deepcopy(ade_gen[:, 49//index_rescale])
-    fde8_gen = np.sqrt(fde_x_error_gen ** 2 + fde_y_error_gen ** 2)
+    fde8_gen = np.hypot(fde_x_error_gen, fde_y_error_gen)
     avg_fde_gen = (fde3_gen + fde5_gen + fde8_gen)/3
     fde_score = np.ones_like(avg_fde_gen) - avg_fde_gen/FDE_THRESHHOLD
     fde_score = np.where(fde_score < 0, np.zeros_like(fde_score), fde_score)
@@ -238,7 +238,7 @@ def compute_metrics(prediction: EvalPrediction):
         next_step_labels = prediction_by_generation['next_step_labels']
         next_step_fde_x_error_gen = next_step[:, -1, 0] - next_step_labels[:, -1, 0]
         next_step_fde_y_error_gen = next_step[:, -1, 1] - next_step_labels[:, -1, 1]
-        next_step_fde_gen = np.sqrt(next_step_fde_x_error_gen ** 2 + next_step_fde_y_error_gen ** 2)
+        next_step_fde_gen = np.hypot(next_step_fde_x_error_gen, next_step_fde_y_error_gen)
         item_to_save['convergence_rate'] = next_step_fde_gen / fde8_gen
         eval_result['convergence_rate'] = (next_step_fde_gen / fde8_gen).mean()
 
@@ -258,9 +258,9 @@ def compute_metrics(prediction: EvalPrediction):
         heading_error_gen = abs(normalize_angles(heading_diff_gen))
 
         ahe1_gen = copy.deepcopy(heading_error_gen[:, 0])
-        ahe3_gen = np.mean(copy.deepcopy(heading_error_gen[:, :(30//index_rescale)]), axis=1)
-        ahe5_gen = np.mean(copy.deepcopy(heading_error_gen[:, :(50//index_rescale)]), axis=1)
-        ahe8_gen = np.mean(copy.deepcopy(heading_error_gen[:, :(80//index_rescale)]), axis=1)
+        ahe3_gen = np.mean(heading_error_gen[:, :(30//index_rescale)], axis=1)
+        ahe5_gen = np.mean(heading_error_gen[:, :(50//index_rescale)], axis=1)
+        ahe8_gen = np.mean(heading_error_gen[:, :(80//index_rescale)], axis=1)
         avg_ahe = (ahe3_gen + ahe5_gen + ahe8_gen)/3
         ahe_score = np.ones_like(avg_ahe) - avg_ahe/HEADING_ERROR_THRESHHOLD
         ahe_score = np.where(ahe_score < 0, np.zeros_like(ahe_score), ahe_score)
@@ -312,9 +312,9 @@ def compute_metrics(prediction: EvalPrediction):
     fde_x_error_for = prediction_trajectory_by_forward[:, -1, 0] - labels[:, -1, 0]
     fde_y_error_for = prediction_trajectory_by_forward[:, -1, 1] - labels[:, -1, 1]
 
-    ade_for = np.sqrt(ade_x_error_for ** 2 + ade_y_error_for ** 2).mean()
+    ade_for = np.hypot(ade_x_error_for, ade_y_error_for).mean()
     eval_result['ade_forward'] = ade_for
-    fde_for = np.sqrt(fde_x_error_for ** 2 + fde_y_error_for ** 2).mean()
+    fde_for = np.hypot(fde_x_error_for, fde_y_error_for).mean()
     eval_result['fde_forward'] = fde_for
     if 'key_points_logits' in prediction_by_generation:
         assert len(selected_indices) >= 1, selected_indices
@@ -343,9 +343,9 @@ def compute_metrics(prediction: EvalPrediction):
             fde_y_error_key_points_for = prediction_key_points_by_forward[:, 0, 1] - label_key_points[:, 0, 1]
         else:
             assert False, selected_indices
-        ade_key_points_for = np.sqrt(ade_x_error_key_points_for ** 2 + ade_y_error_key_points_for ** 2).mean()
+        ade_key_points_for = np.hypot(ade_x_error_key_points_for, ade_y_error_key_points_for).mean()
         eval_result['ade_keypoints_forward'] = ade_key_points_for
-        fde_key_points_for = np.sqrt(fde_x_error_key_points_for ** 2 + fde_y_error_key_points_for ** 2).mean()
+        fde_key_points_for = np.hypot(fde_x_error_key_points_for, fde_y_error_key_points_for).mean()
         eval_result['fde_keypoints_forward'] = fde_key_points_for
 
         if prediction_key_points_by_forward.shape[-1] == 4:
@@ -56,6 +56,15 @@ class ModelArguments:
     pretrain_encoder: Optional[bool] = field(
         default=False,
     )
+    skip_resnet_classifier: Optional[bool] = field(
+        default=False, metadata={"help": "Use the pooled ResNet features directly when their dimension equals n_embd // 2"}
+    )
+    disable_vit_cudagraph: Optional[bool] = field(
+        default=False, metadata={"help": "Disable capturing the raster encoder into CUDA graphs at inference"}
+    )
+    generate_with_bf16_autocast: Optional[bool] = field(
+        default=False, metadata={"help": "Run generate under bf16 autocast, training precision is set by --bf16 of the trainer"}
+    )
     k: Optional[int] = field(
         default=1,
         metadata={"help": "Set k for top-k predictions, set to -1 to not use top-k predictions."},
@@ -147,6 +156,15 @@ class ModelArguments:
     key_points_diffusion_decoder_load_from: Optional[str] = field(
         default=None, metadata={"help": "From which file to load the pretrained key_points_diffusion_decoder."}
     )
+    checkpoint_direct_io: Optional[bool] = field(
+        default=False, metadata={"help": "Read checkpoints larger than 512MB with O_DIRECT, bypassing the page cache for one-shot loads."}
+    )
+    checkpoint_load_workers: Optional[int] = field(
+        default=8, metadata={"help": "Number of threads reading the diffusion decoder checkpoint into memory in parallel chunks, 0 to keep the tensors memory mapped."}
+    )
+    convert_checkpoint_to_safetensors: Optional[bool] = field(
+        default=False, metadata={"help": "Save a .safetensors copy next to the diffusion decoder checkpoint on the first load, later loads prefer it."}
+    )
     ######## end of diffusion decoder args ########
 
     ######## begin of camera images args ########
@@ -205,6 +223,9 @@ class ModelArguments:
     diffusion_feature_save_dir: Optional[str] = field(
         default = None, metadata = {"help":"where to save diffusion dataset."}
     )
+    diffusion_feature_shard: Optional[bool] = field(
+        default = False, metadata = {"help":"Append diffusion features to one raw shard per rank instead of one .pth file per key point."}
+    )
     ######## end of nuplan args ########
 
     ######## begin of WOMD args ########
@@ -261,6 +282,12 @@ class ModelArguments:
     sync_norm: Optional[bool] = field(
         default=False, metadata={"help": "use SyncBatchNorm over all GPUs."}
     )
+    compile_backbone: Optional[bool] = field(
+        default=False, metadata={"help": "Compile the transformer backbone with torch.compile(mode='reduce-overhead') for training, requires torch>=2.2"}
+    )
+    skip_scratch_init: Optional[bool] = field(
+        default=False, metadata={"help": "Allocate the parameters of a scratch model without initializing them. Only for resuming from a checkpoint that restores all weights."}
+    )
     ######## temporal model args, check your model config before using it! ########
     trajectory_prediction_mode: Optional[str] = field(
         default='all_frames', metadata={"help": "choose from [all_frames, start_frame, both, rebalance], experimental [off_roadx100, ]"}
@@ -449,6 +476,10 @@ class DataTrainingArguments:
                                         "3: cyclist on WOMD"
                                         "any combination of numbers will be decoded into list of int (1 2;2 3;1 3)"}
     )
+    cache_concat_dataset: Optional[bool] = field(
+        default=False, metadata={"help": "Save the concatenation of the city datasets of each split under "
+                                         "index/_concat_cache and load it on later runs, rebuilt when a city changes"}
+    )
 
 
 @dataclass
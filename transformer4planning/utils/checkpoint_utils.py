@@ -0,0 +1,374 @@
+import io
+import os
+import mmap
+import collections
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from transformers.utils import logging
+
+logger = logging.get_logger("transformers")
+
+try:
+    import safetensors.torch
+except ImportError:
+    safetensors = None
+
+SAFETENSORS_SUFFIX = '.safetensors'
+
+
+# checkpoints above this size are read with O_DIRECT when direct io is enabled
+DIRECT_IO_MIN_SIZE = 512 << 20
+DIRECT_IO_ALIGNMENT = 2 << 20
+DIRECT_IO_CHUNK_SIZE = 4 << 20
+
+
+class _BufferReader(io.RawIOBase):
+    """
+    Read-only seekable file over a memoryview, so torch.load can parse a buffer without copying it into BytesIO.
+    """
+    def __init__(self, buffer):
+        super().__init__()
+        self.buffer = buffer
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = len(self.buffer) + offset
+        return self.position
+
+    def readinto(self, b):
+        length = max(0, min(len(b), len(self.buffer) - self.position))
+        b[:length] = self.buffer[self.position:self.position + length]
+        self.position += length
+        return length
+
+
+def _allocate_aligned_buffer(size):
+    size = (size + DIRECT_IO_ALIGNMENT - 1) // DIRECT_IO_ALIGNMENT * DIRECT_IO_ALIGNMENT
+    flags = mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS
+    if hasattr(mmap, 'MAP_HUGETLB'):
+        try:
+            return mmap.mmap(-1, size, flags=flags | mmap.MAP_HUGETLB)
+        except OSError:
+            # no huge pages reserved, page aligned memory still satisfies O_DIRECT
+            pass
+    return mmap.mmap(-1, size, flags=flags)
+
+
+def _direct_read(path):
+    """
+    Read the whole file with O_DIRECT into an aligned anonymous buffer, skipping the page cache.
+    Returns the buffer and the file size.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+    try:
+        size = os.fstat(fd).st_size
+        buffer = _allocate_aligned_buffer(size)
+        view = memoryview(buffer)
+        offset = 0
+        while offset < size:
+            read = os.preadv(fd, [view[offset:offset + DIRECT_IO_CHUNK_SIZE]], offset)
+            if read == 0:
+                break
+            offset += read
+        view.release()
+    finally:
+        os.close(fd)
+    return buffer, size
+
+
+def _advise_sequential(path):
+    # checkpoints are read once from start to end: a larger readahead window, and the kernel starts reading
+    # asynchronously before the loader gets to the file
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def load_state_dict_file(path, direct_io=False):
+    """
+    Load a state dict saved by torch.save on cpu.
+    The file is memory mapped, tensors are paged in on demand instead of being read into a full copy first.
+    With direct_io, large files are read once with O_DIRECT instead, bypassing the page cache.
+    """
+    if direct_io and hasattr(os, 'O_DIRECT') and os.path.getsize(path) > DIRECT_IO_MIN_SIZE:
+        try:
+            buffer, size = _direct_read(path)
+        except OSError as e:
+            # e.g. the file system does not support O_DIRECT
+            logger.warning(f'Failed to read {path} with O_DIRECT, loading with mmap: {e}')
+        else:
+            view = memoryview(buffer)[:size]
+            try:
+                # tensors are copied out of the buffer into their own storages while loading
+                return torch.load(_BufferReader(view), map_location='cpu', weights_only=True)
+            finally:
+                view.release()
+                buffer.close()
+    _advise_sequential(path)
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except RuntimeError as e:
+        # mmap only supports the zipfile format of torch>=1.6
+        logger.warning(f'Failed to memory map {path}, loading without mmap: {e}')
+        return torch.load(path, map_location='cpu', weights_only=True)
+
+
+def materialize_state_dict(state_dict, max_workers=8, chunk_size=DIRECT_IO_CHUNK_SIZE * 4):
+    """
+    Copy the memory mapped tensors of a state dict into memory with a thread pool.
+    Large tensors are split into chunks, so the page faults of one big file run in parallel
+    instead of one after another on the first use of each parameter.
+    Returns a new state dict, the given one is left untouched.
+    """
+    outputs = {}
+    jobs = []
+    materialized = {}
+    for key, value in state_dict.items():
+        if not isinstance(value, torch.Tensor) or value.device.type != 'cpu':
+            materialized[key] = value
+            continue
+        if not value.is_contiguous():
+            materialized[key] = value.clone(memory_format=torch.contiguous_format)
+            continue
+        # tensors sharing one storage in the file stay shared
+        tensor_key = (value.data_ptr(), value.dtype, tuple(value.shape))
+        if tensor_key not in outputs:
+            outputs[tensor_key] = torch.empty_like(value)
+            source, target = value.view(-1).view(torch.uint8), outputs[tensor_key].view(-1).view(torch.uint8)
+            for start in range(0, source.numel(), chunk_size):
+                jobs.append((target[start:start + chunk_size], source[start:start + chunk_size]))
+        materialized[key] = outputs[tensor_key]
+    if len(jobs) > 0:
+        # the copies release the GIL
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+            list(executor.map(lambda job: job[0].copy_(job[1]), jobs))
+    return materialized
+
+
+def copy_state_dict_to_device(state_dict, device, max_workers=8):
+    """
+    Copy the cpu tensors of a state dict to a gpu. A thread pool reads the tensors into pinned memory, and each
+    tensor is copied to the device on a side stream as soon as it is ready, so the transfers overlap with the
+    reads of the following tensors. The current stream waits for the copies before the tensors are used.
+    """
+    copy_stream = torch.cuda.Stream(device)
+    outputs = {}
+    on_device = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pinned_futures = {}
+        for key, value in state_dict.items():
+            if not isinstance(value, torch.Tensor) or value.device.type != 'cpu':
+                continue
+            # tensors sharing one storage in the file stay shared
+            tensor_key = (value.data_ptr(), value.dtype, tuple(value.shape), value.stride())
+            if tensor_key not in pinned_futures:
+                pinned_futures[tensor_key] = executor.submit(value.pin_memory)
+        for key, value in state_dict.items():
+            if not isinstance(value, torch.Tensor) or value.device.type != 'cpu':
+                outputs[key] = value
+                continue
+            tensor_key = (value.data_ptr(), value.dtype, tuple(value.shape), value.stride())
+            if tensor_key not in on_device:
+                pinned = pinned_futures[tensor_key].result()
+                with torch.cuda.stream(copy_stream):
+                    # the pinned source is kept alive by the host allocator until the copy is done
+                    on_device[tensor_key] = pinned.to(device, non_blocking=True)
+            outputs[key] = on_device[tensor_key]
+    current_stream = torch.cuda.current_stream(device)
+    current_stream.wait_stream(copy_stream)
+    for each_tensor in on_device.values():
+        # allocated on the copy stream, used on the current stream from now on
+        each_tensor.record_stream(current_stream)
+    return outputs
+
+
+# (path, mtime_ns, size) -> memory mapped state dict, the most recently used last
+# keyed by mtime and size, so an overwritten checkpoint is read again
+_STATE_DICT_CACHE = collections.OrderedDict()
+STATE_DICT_CACHE_SIZE = 4
+
+
+def _load_cached_state_dict_file(path):
+    stat = os.stat(path)
+    cache_key = (path, stat.st_mtime_ns, stat.st_size)
+    if cache_key in _STATE_DICT_CACHE:
+        _STATE_DICT_CACHE.move_to_end(cache_key)
+        return _STATE_DICT_CACHE[cache_key]
+    _advise_sequential(path)
+    try:
+        state_dict = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except RuntimeError:
+        # files that cannot be memory mapped are fully read into process memory,
+        # caching them would keep a second copy of the weights alive next to the module
+        return load_state_dict_file(path)
+    # the cached tensors are memory mapped, the pages belong to the page cache and do not pin process memory
+    _STATE_DICT_CACHE[cache_key] = state_dict
+    while len(_STATE_DICT_CACHE) > STATE_DICT_CACHE_SIZE:
+        _STATE_DICT_CACHE.popitem(last=False)
+    return state_dict
+
+
+def convert_checkpoint_to_safetensors(path, state_dict=None):
+    """
+    Save the torch checkpoint at path as path + '.safetensors', which load_state_dict_into prefers afterwards.
+    Returns the path of the converted file, or None if it could not be written.
+    """
+    if safetensors is None:
+        logger.warning('safetensors is not installed, skip converting the checkpoint.')
+        return None
+    if state_dict is None:
+        state_dict = load_state_dict_file(path)
+    target_path = path + SAFETENSORS_SUFFIX
+    # write to a temporary file first, other ranks may be reading the target at the same time
+    temp_path = f'{target_path}.{os.getpid()}.tmp'
+    try:
+        safetensors.torch.save_file({key: value.contiguous() for key, value in state_dict.items()
+                                     if isinstance(value, torch.Tensor)}, temp_path, metadata={"format": "pt"})
+        os.replace(temp_path, target_path)
+    except (OSError, RuntimeError, ValueError) as e:
+        # read only checkpoint folders or tensors sharing memory
+        logger.warning(f'Failed to convert {path} to safetensors: {e}')
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+    logger.info(f'Converted {path} to {target_path}')
+    return target_path
+
+
+def _assign_state_dict(module, state_dict, path, strict):
+    incompatible_keys = module.load_state_dict(state_dict, strict=strict, assign=True)
+    if len(incompatible_keys.missing_keys) > 0 or len(incompatible_keys.unexpected_keys) > 0:
+        logger.warning('Loaded %s with %d missing keys %s and %d unexpected keys %s', path,
+                       len(incompatible_keys.missing_keys), incompatible_keys.missing_keys,
+                       len(incompatible_keys.unexpected_keys), incompatible_keys.unexpected_keys)
+    return incompatible_keys
+
+
+def _is_safetensors_sibling_current(path):
+    """
+    Whether the path + '.safetensors' sibling exists and is not older than the torch file at path,
+    a torch file overwritten after the conversion is loaded (and converted again) instead of the stale sibling.
+    """
+    sibling_path = path + SAFETENSORS_SUFFIX
+    if not os.path.isfile(sibling_path):
+        return False
+    return not os.path.exists(path) or os.path.getmtime(sibling_path) >= os.path.getmtime(path)
+
+
+def load_state_dict_into(module, path, direct_io=False, load_workers=0, convert_to_safetensors=False, strict=True):
+    """
+    Load the state dict at path into the module, assigning the loaded tensors instead of copying them into
+    the existing parameters. With strict=False, missing and unexpected keys are logged instead of raising.
+    A path + '.safetensors' sibling is preferred if it is not older than the torch file, it is memory mapped and
+    loaded onto the device of the module directly. With convert_to_safetensors, the sibling is written (again)
+    whenever the torch file is loaded instead.
+    With load_workers > 0, the tensors are read into memory in parallel chunks before loading, and the
+    deserialized file is kept in an in-process cache, so loading the same unchanged file again skips parsing it.
+    If the module already lives on a gpu, the tensors are staged in pinned memory and copied to its device
+    asynchronously with copy_state_dict_to_device, so the parameters are not first materialized on cpu and
+    copied over one by one.
+    """
+    first_parameter = next(module.parameters(), None)
+    device = first_parameter.device if first_parameter is not None else torch.device('cpu')
+    if safetensors is not None and _is_safetensors_sibling_current(path):
+        _advise_sequential(path + SAFETENSORS_SUFFIX)
+        state_dict = safetensors.torch.load_file(path + SAFETENSORS_SUFFIX,
+                                                 device=str(device) if device.type == 'cuda' else 'cpu')
+        return _assign_state_dict(module, state_dict, path, strict)
+    # fail fast with a clear message instead of deep inside the unpickler
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f'Checkpoint {path} does not exist.')
+    if os.path.getsize(path) == 0:
+        raise ValueError(f'Checkpoint {path} is empty.')
+    if not direct_io and (load_workers > 0 or device.type == 'cuda'):
+        # both paths below copy the tensors, so the module never shares storage with the cached state dict
+        state_dict = _load_cached_state_dict_file(path)
+    else:
+        state_dict = load_state_dict_file(path, direct_io=direct_io)
+    if convert_to_safetensors:
+        convert_checkpoint_to_safetensors(path, state_dict)
+    if device.type == 'cuda':
+        state_dict = copy_state_dict_to_device(state_dict, device, max_workers=max(load_workers, 1))
+    elif load_workers > 0:
+        state_dict = materialize_state_dict(state_dict, max_workers=load_workers)
+    return _assign_state_dict(module, state_dict, path, strict)
+
+
+# weight files of a saved model, optimizer / scheduler states in checkpoint folders are not loaded for inference
+WEIGHT_FILE_PREFIXES = ('pytorch_model', 'model')
+WEIGHT_FILE_SUFFIXES = ('.bin', '.safetensors', '.pth', '.pt')
+
+
+def _populate_page_cache(path, chunk_size=64 << 20):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        if hasattr(mmap, 'MAP_POPULATE'):
+            # linux: the kernel faults in the whole file in one call
+            mm = mmap.mmap(f.fileno(), 0, flags=mmap.MAP_PRIVATE | mmap.MAP_POPULATE, prot=mmap.PROT_READ)
+            mm.close()
+        else:
+            while f.read(chunk_size):
+                pass
+
+
+def wait_for_prefetch(futures):
+    for each_future in futures:
+        try:
+            each_future.result()
+        except OSError as e:
+            # prefetching is only an optimization, loading reads the files again anyway
+            logger.warning(f'Failed to prefetch checkpoint files: {e}')
+
+
+def prefetch_checkpoint_files(paths, max_workers=8, wait=True):
+    """
+    Read the weight files of the given checkpoint files or folders into the page cache concurrently,
+    so that the following sequential torch.load / from_pretrained are served from memory.
+    With wait=False, returns the futures of the reads, pass them to wait_for_prefetch when the files are needed.
+    """
+    files = []
+    for each_path in paths:
+        if each_path is None:
+            continue
+        if _is_safetensors_sibling_current(each_path):
+            # the converted sibling is what gets loaded
+            files.append(each_path + SAFETENSORS_SUFFIX)
+        elif os.path.isfile(each_path):
+            files.append(each_path)
+        elif os.path.isdir(each_path):
+            files += [os.path.join(each_path, each_file) for each_file in sorted(os.listdir(each_path))
+                      if each_file.startswith(WEIGHT_FILE_PREFIXES) and each_file.endswith(WEIGHT_FILE_SUFFIXES)]
+    if len(files) == 0:
+        return []
+    for each_file in files:
+        _advise_sequential(each_file)
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(files)))
+    futures = [executor.submit(_populate_page_cache, each_file) for each_file in files]
+    # the running reads finish in the background, the threads exit afterwards
+    executor.shutdown(wait=False)
+    if wait:
+        wait_for_prefetch(futures)
+    return futures
@@ -71,15 +71,12 @@ def get_closest_lane_on_route(pred_key_point_global,
     return closest_lane_id, dist[closest_index]
 
 
-def get_closest_lane_point_on_route(pred_key_point_global,
-                                    route_ids,
-                                    road_dic,
-                                    include_yaw=False):
-
-    # loop over all the route ids
-    pred_key_point_global_copy = copy.deepcopy(pred_key_point_global)
+def get_route_lane_points(route_ids, road_dic, include_yaw=False):
+    """
+    Collect the points of all lanes on the route.
+    return (route_lane_pts_np, lane_ids) with one lane id per point, or (None, None) if no lane is found
+    """
     route_lanes = []
-    route_ids = route_ids[:100]
     for each_route_block in route_ids:
         if each_route_block == -1:
             continue
@@ -102,31 +99,58 @@ def get_closest_lane_point_on_route(pred_key_point_global,
             route_lane_pts.append(np.concatenate([point, yaw], axis=1))
         else:
             route_lane_pts.append(road_dic[each_lane]['xyz'][:, :2])
-        lane_ids += [each_lane] * road_dic[each_lane]['xyz'].shape[0]
+        lane_ids.append(np.full(road_dic[each_lane]['xyz'].shape[0], each_lane))
     if len(route_lane_pts) == 0:
+        return None, None
+    # concatenate all points in the list in one dimension
+    return np.concatenate(route_lane_pts, axis=0), np.concatenate(lane_ids, axis=0)
+
+
+def get_closest_lane_point_on_route(pred_key_point_global,
+                                    route_ids,
+                                    road_dic,
+                                    include_yaw=False,
+                                    route_cache=None):
+    """
+    Find the closest lane point on the route and check if the point is inside the closest route road block.
+    `route_cache`: optional dict reused over queries with the same route_ids and road_dic, e.g. all points
+                   of one trajectory, to keep the lane points, their KD-tree and the road block polygons
+    """
+    from scipy.spatial import cKDTree
+    route_ids = route_ids[:100]
+    cache_key = (tuple(route_ids), include_yaw)
+    if route_cache is not None and cache_key in route_cache:
+        route_lane_pts_np, lane_ids, lane_pts_tree = route_cache[cache_key]
+    else:
+        route_lane_pts_np, lane_ids = get_route_lane_points(route_ids, road_dic, include_yaw)
+        lane_pts_tree = None if route_lane_pts_np is None else cKDTree(route_lane_pts_np[:, :2])
+        if route_cache is not None:
+            route_cache[cache_key] = (route_lane_pts_np, lane_ids, lane_pts_tree)
+    if route_lane_pts_np is None:
         print('no route lane points found at all ', route_ids, len(road_dic.keys()))
         return None, None, None, None, None
-    # concatenate all points in the list in one dimension
-    route_lane_pts_np = np.concatenate(route_lane_pts, axis=0)
     # get the closest point over all of the selected lanes
-    dist = np.linalg.norm(route_lane_pts_np[:, :2] - pred_key_point_global_copy[:2], axis=1)
-    closest_index = np.argmin(dist)
+    dist, closest_index = lane_pts_tree.query(pred_key_point_global[:2], k=1)
     closest_lane_point = route_lane_pts_np[closest_index]
 
     # check if point in route road block
-    closest_lane_id = lane_ids[closest_index]
+    closest_lane_id = int(lane_ids[closest_index])
     closest_road_block = None
     for each_route_block in road_dic[closest_lane_id]['upper_level']:
         if each_route_block in route_ids:
             closest_road_block = each_route_block
             break
     assert closest_road_block is not None, 'closest_road_block is None'
-    line = geometry.LineString(road_dic[closest_road_block]['xyz'][:, :2])
-    point = geometry.Point(pred_key_point_global_copy[:2])
-    polygon = geometry.Polygon(line)
+    polygon = None if route_cache is None else route_cache.get(('polygon', closest_road_block), None)
+    if polygon is None:
+        line = geometry.LineString(road_dic[closest_road_block]['xyz'][:, :2])
+        polygon = geometry.Polygon(line)
+        if route_cache is not None:
+            route_cache[('polygon', closest_road_block)] = polygon
+    point = geometry.Point(pred_key_point_global[:2])
     on_road = polygon.contains(point)
 
-    return closest_lane_point, dist[closest_index], closest_index, closest_lane_id, on_road
+    return closest_lane_point, dist, closest_index, closest_lane_id, on_road
 
 
 def normalize_angle(angle):
@@ -1,7 +1,7 @@
 import logging
 import pathlib
 from concurrent.futures import Future
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 
 from nuplan.common.utils.s3_utils import is_s3_path
 from nuplan.planning.scenario_builder.abstract_scenario import AbstractScenario
@@ -21,6 +21,11 @@ class DummyCallback(AbstractCallback):
     Callback for simulation logging/object serialization to disk.
     """
 
+    # every hook is a no-op, simulation setups drop it instead of dispatching each hook per step
+    IS_NOOP = True
+    # shared by all instances, no callback work is ever scheduled
+    _EMPTY_FUTURES: Tuple[Future[None], ...] = ()
+
     def __init__(
         self,
     ):
@@ -33,12 +38,12 @@ class DummyCallback(AbstractCallback):
         pass
 
     @property
-    def futures(self) -> List[Future[None]]:
+    def futures(self) -> Tuple[Future[None], ...]:
         """
         Returns a list of futures, eg. for the main process to block on.
         :return: any futures generated by running any part of the callback asynchronously.
         """
-        return self._futures
+        return self._EMPTY_FUTURES
 
     def on_initialization_start(self, setup: SimulationSetup, planner: AbstractPlanner) -> None:
         """
@@ -52,6 +52,8 @@ def run_simulation(cfg: DictConfig, planners: Optional[Union[AbstractPlanner, Li
     # Build simulation callbacks
     callbacks_worker_pool = build_callbacks_worker(cfg)
     callbacks = build_simulation_callbacks(cfg=cfg, output_dir=common_builder.output_dir, worker=callbacks_worker_pool)
+    # Drop no-op callbacks so the simulation loop does not call their hooks at every step
+    callbacks = [callback for callback in callbacks if not getattr(callback, 'IS_NOOP', False)]
 
     # Remove planner from config to make sure run_simulation does not receive multiple planner specifications.
     if planners and 'planner' in cfg.keys():